@@ -14,7 +14,7 @@ metadata = {
     'protocolName': 'Station C qPCR setup Version 2',
     'author': 'Aitor Gastaminza, José Luis Villanueva (Hospital Clinic Barcelona) & Alex Gasulla',
     'source': 'Hospital Clínic Barcelona',
-    'apiLevel': '2.0',
+    'apiLevel': '2.3',
     'description': 'Protocol for sample setup (C) prior to qPCR'
     }
 
@@ -34,8 +34,15 @@ extra_dispensal = 5  # Extra volume for master mix in each distribute transfer
 diameter_screwcap = 8.25  # Diameter of the screwcap
 temperature = 25  # Temperature of temp module
 volume_cone = 50  # Volume in ul that fit in the screwcap cone
+volume_screwcap = 1900  # Volume in ul a 2 ml screwcap is filled up to, with room to pipette and mix
 pipette_allowed_capacity = 180 # Volume allowed in the pipette of 200µl
 x_offset = [0,0]
+mmix_multichannel = False  # Do you want to aliquot MMIX into 8-tube strips and stamp it into the qPCR plate with the m20?
+strip_dead_volume = 5  # Volume in ul left in each strip tube
+pcr_384 = False  # Do you want to set up a 384 well qPCR plate with the elutions of several plates?
+num_plates = 4  # Elution plates (1 to 4, NUM_SAMPLES samples each) loaded into the quadrants of the 384 well plate
+queued_plates = 1  # qPCR plates set up back to back, each with fresh MMIX and its own elution plates, with a pause to swap them
+priority_columns = []  # STAT lane: elution plate columns (1 based) with priority samples from station A, transferred first
 
 #Available master mastermixes
 MMIX_available={1: 'Seegene', 2: 'Universal', 3: 'Universal_IDT',4: 'Clinic'}
@@ -51,13 +58,26 @@ MMIX_make_location = 9 # Cell C1 in which the first tube for the MMIX will be pl
 
 volume_mmix = MMIX_vol[mmix_selection][0]  # Volume of transfered master mix per well
 
+plates = num_plates if pcr_384 == True else 1  # Elution plates set up in this run
+total_samples = NUM_SAMPLES * plates  # Samples in the qPCR plate
+
+# With mmix_multichannel each strip column (filled up to pipette_allowed_capacity) feeds a group of qPCR plate columns of one elution plate
+strip_cols = 0
+if mmix_multichannel == True:
+    strip_cols = plates * math.ceil(math.ceil(NUM_SAMPLES / 8) / math.floor((pipette_allowed_capacity - strip_dead_volume) / volume_mmix))
+mmix_dead_volume = 8 * strip_cols * strip_dead_volume # Master mix left in the strips
+
 MMIX_make = {}
 for mmix_type in MMIX_recipe.keys():
     MMIX_make[mmix_type] = []
     for needed_vol in MMIX_recipe[mmix_type]:
-        MMIX_make[mmix_type].append(needed_vol * NUM_SAMPLES * 1.1)
+        MMIX_make[mmix_type].append(needed_vol * (total_samples * 1.1 + mmix_dead_volume / MMIX_vol[mmix_type][0]))
+
+volume_mmix_available = (total_samples * 1.1 * MMIX_vol[mmix_selection][0]) + mmix_dead_volume  # Total volume of mastermix that will be prepared
 
-volume_mmix_available = (NUM_SAMPLES * 1.1 * MMIX_vol[mmix_selection][0])  # Total volume of mastermix that will be prepared
+# MMIX tubes of each elution plate and tubes of each component, so that no tube holds more than volume_screwcap
+mmix_tubes = max(MMIX_vol[mmix_selection][1], math.ceil(volume_mmix_available / plates / volume_screwcap))
+component_tubes = [math.ceil(vol / volume_screwcap) for vol in MMIX_make[mmix_selection]]
 
 # Calculated variables
 area_section_screwcap = (np.pi * diameter_screwcap**2) / 4
@@ -88,6 +108,80 @@ def run(ctx: protocol_api.ProtocolContext):
             os.mkdir(folder_path)
         file_path = folder_path + '/Station_C_qPCR_time_log.txt'
 
+    ##########
+    # Event journal: one json line per command and per step boundary, timed with the monotonic
+    # clock from the start of the run. It is only written on the robot.
+    journal = {'file': None, 'buffer': [], 'start': time.monotonic(), 'plate': 1, 'step': 0, 'running': []}
+
+    def journal_event(event, t = None, **data):
+        record = {'t': round((time.monotonic() if t is None else t) - journal['start'], 3), 'event': event,
+                  'plate': journal['plate'], 'step': journal['step']}
+        record.update({key: value for key, value in data.items() if value is not None})
+        journal['buffer'].append(json.dumps(record, default = str))
+
+    def journal_flush():
+        '''
+        Writes the buffered records at once. It is done at step boundaries and pauses, while the
+        robot stands still, so that writing to the SD card does not stall a movement. Only whole
+        lines are written and synced, so a run that aborts leaves a valid journal up to its last flush
+        '''
+        if journal['file'] is not None and journal['buffer']:
+            journal['file'].write('\n'.join(journal['buffer']) + '\n')
+            journal['file'].flush()
+            os.fsync(journal['file'].fileno())
+        journal['buffer'] = []
+
+    def journal_command(message):
+        '''
+        Broker callback of every command: the record is buffered when the command ends, with the
+        time it started, its duration and the well and volume it used
+        '''
+        if message['$'] == 'before':
+            journal['running'].append(time.monotonic())
+            if message['name'] == 'command.PAUSE':
+                journal_flush()
+            return
+        start = journal['running'].pop() if journal['running'] else time.monotonic()
+        payload = message['payload']
+        location = payload.get('location')
+        if location is not None and hasattr(location, 'labware'):
+            location = location.labware # A Location is a point and the well it refers to
+        journal_event('command', t = start, name = message['name'].split('.')[-1].lower(),
+                      seconds = round(time.monotonic() - start, 3), well = str(location) if location is not None else None,
+                      volume = payload.get('volume'), text = payload.get('text'))
+
+    def journal_step(step, description):
+        '''
+        Step boundary: the records so far are written and the next ones belong to step
+        '''
+        journal_flush()
+        journal['step'] = step
+        journal_event('step_start', description = description)
+
+    def journal_step_end(**stats):
+        journal_event('step_end', **stats)
+        journal_flush()
+        journal['step'] = 0 # Pauses and swaps between steps
+
+    def journal_close():
+        '''
+        Ends the journal with the run_end record, closes it and stops listening to the commands.
+        Called from a finally clause, so the journal of a run that raises is also complete
+        '''
+        journal_event('run_end', seconds = round(time.monotonic() - journal['start'], 3))
+        journal_flush()
+        if journal['file'] is not None:
+            journal_unsubscribe()
+            journal['file'].close()
+            journal['file'] = None
+
+    journal_unsubscribe = None
+    if not ctx.is_simulating():
+        journal['file'] = open(folder_path + '/Station_C_qPCR_journal_' + datetime.now().strftime('%Y%m%d_%H%M%S') + '.jsonl', 'w')
+        journal_unsubscribe = ctx.broker.subscribe('command', journal_command) # Every command of the run
+    journal_event('run_start', protocol = metadata['protocolName'], NUM_SAMPLES = NUM_SAMPLES,
+                  date = datetime.now().isoformat())
+
     # Define Reagents as objects with their properties
     class Reagent:
         def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, rinse,
@@ -115,7 +209,7 @@ def run(ctx: protocol_api.ProtocolContext):
                       flow_rate_aspirate = 1,
                       flow_rate_dispense = 1,
                       reagent_reservoir_volume = volume_mmix_available,
-                      num_wells = MMIX_vol[mmix_selection][1], #change with num samples
+                      num_wells = mmix_tubes * plates, #change with num samples
                       delay = 0,
                       h_cono = h_cone,
                       v_fondo = volume_cone  # V cono
@@ -275,26 +369,41 @@ def run(ctx: protocol_api.ProtocolContext):
     ############################################
     # tempdeck
     tempdeck = ctx.load_module('tempdeck', '4')
-    tempdeck.set_temperature(temperature)
+    tempdeck.start_set_temperature(temperature) # Ramps in the background while MMIX is made
 
     ##################################
     # qPCR plate - final plate, goes to PCR
-    qpcr_plate = tempdeck.load_labware(
-        'abi_fast_qpcr_96_alum_opentrons_100ul',
-        'chilled qPCR final plate')
+    if pcr_384 == True:
+        qpcr_plate = tempdeck.load_labware(
+            'biorad_384_wellplate_50ul',
+            'chilled 384 qPCR final plate')
+    else:
+        qpcr_plate = tempdeck.load_labware(
+            'abi_fast_qpcr_96_alum_opentrons_100ul',
+            'chilled qPCR final plate')
 
     ##################################
-    # Sample plate - comes from B
-    source_plate = ctx.load_labware(
-        "kingfisher_std_96_wellplate_550ul", '1',
-        'chilled KF plate with elutions (alum opentrons)')
-    samples = source_plate.wells()[:NUM_SAMPLES]
+    # Sample plates - come from B, one in 96 mode and up to four in 384 mode
+    source_slots = ['1', '7', '8', '9'][:plates]
+    source_plates = [
+        ctx.load_labware(
+            "kingfisher_std_96_wellplate_550ul", slot,
+            'chilled KF plate ' + str(p + 1) + ' with elutions (alum opentrons)')
+        for p, slot in enumerate(source_slots)
+    ]
+    source_plate = source_plates[0]
 
     ##################################
     # Load Tipracks
+    # 20µl tips: a tip column for the MMIX stamping and one per sample column. The racks the run
+    # needs are loaded in the free slots; if the deck can not hold them they are replaced in step 3
+    tips20_stamping = 8 if STEPS[2]['Execute'] == True and mmix_multichannel == True else 0
+    tips20_needed = tips20_stamping + (8 * num_cols * plates if STEPS[3]['Execute'] == True else 0)
+    tips20_slots = [slot for slot in ['5', '11', '3', '7', '8', '9']
+                    if slot not in source_slots and (slot != '3' or mmix_multichannel == False)]
     tips20 = [
         ctx.load_labware('opentrons_96_filtertiprack_20ul', slot)
-        for slot in ['5']
+        for slot in tips20_slots[:max(1, min(math.ceil(tips20_needed / 96), len(tips20_slots)))]
     ]
 
     tips200 = [
@@ -302,18 +411,89 @@ def run(ctx: protocol_api.ProtocolContext):
         for slot in ['6','10']
     ]
 
+    ##################################
+    # 8-tube strips for MMIX, stamped with the multichannel
+    if mmix_multichannel == True:
+        strip_rack = ctx.load_labware(
+            'opentrons_96_aluminumblock_generic_pcr_strip_200ul', '3',
+            'Bloque Aluminio opentrons 8-tube strips for MMIX')
+
     ################################################################################
     # Declare which reagents are in each reservoir as well as deepwell and elution plate
-    MMIX.reagent_reservoir = tuberack.rows()[0][:MMIX.num_wells] # 1 row, 2 columns (first ones)
-    MMIX_components.reagent_reservoir=tuberack.wells()[MMIX_make_location:(MMIX_make_location + len(MMIX_make[mmix_selection]))]
-    ctx.comment('Wells in: '+ str(tuberack.rows()[0][:MMIX.num_wells]) + ' element: '+str(MMIX.reagent_reservoir[MMIX.col]))
-    # setup up sample sources and destinations
-    samples = source_plate.wells()[:NUM_SAMPLES]
-    samples_multi = source_plate.rows()[0][:num_cols]
-    pcr_wells = qpcr_plate.wells()[:NUM_SAMPLES]
-    pcr_wells_multi = qpcr_plate.rows()[0][:num_cols]
-    # Divide destination wells in small groups for P300 pipette
-    dests = list(divide_destinations(pcr_wells, size_transfer))
+    MMIX.reagent_reservoir = [tube for row in tuberack.rows() for tube in row][:MMIX.num_wells] # first row, then second
+    # Component tubes from MMIX_make_location on, skipping the MMIX tubes, each component split
+    # in component_tubes tubes with the same share of its volume
+    free_tubes = [tube for tube in tuberack.wells()[MMIX_make_location:] if tube not in MMIX.reagent_reservoir]
+    if len(free_tubes) < sum(component_tubes):
+        raise Exception('The ' + str(MMIX.num_wells) + ' MMIX tubes and ' + str(sum(component_tubes)) +
+                        ' component tubes of ' + MMIX.name + ' for ' + str(total_samples) + ' samples do not fit in the ' +
+                        str(len(tuberack.wells())) + ' well tuberack, reduce NUM_SAMPLES or num_plates')
+    component_sources = []
+    for n in component_tubes:
+        component_sources.append(free_tubes[:n])
+        free_tubes = free_tubes[n:]
+    MMIX_components.reagent_reservoir = [tube for sources in component_sources for tube in sources]
+    if [tube for tube in MMIX_components.reagent_reservoir if tube in MMIX.reagent_reservoir]:
+        raise Exception('MMIX tubes and MMIX component tubes overlap in the tuberack')
+    if MMIX.vol_well_original > volume_screwcap or max(MMIX_make[mmix_selection][c] / n for c, n in enumerate(component_tubes)) > volume_screwcap:
+        raise Exception('A tube of the tuberack would hold more than ' + str(volume_screwcap) + ' ul')
+    ctx.comment('Wells in: '+ str(MMIX.reagent_reservoir) + ' element: '+str(MMIX.reagent_reservoir[MMIX.col]))
+    if len(MMIX_components.reagent_reservoir) > len(component_tubes):
+        for c, (sources, vol) in enumerate(zip(component_sources, MMIX_make[mmix_selection])):
+            ctx.comment('MMIX component ' + str(c + 1) + ': ' + str(round(vol / len(sources), 1)) + ' ul in each of ' +
+                        ', '.join(tube.display_name.split(' ')[0] for tube in sources))
+    # setup up sample sources and destinations, plate after plate. In 384 mode each elution
+    # plate goes to a quadrant: well (row, column) to (2 * row + r, 2 * column + c), so the
+    # multichannel reaches a quadrant column from row r
+    samples = []
+    samples_multi = []
+    pcr_wells = []
+    pcr_wells_multi = []
+    sample_map = []  # plate, elution well and qPCR well of every sample
+    for p, plate in enumerate(source_plates):
+        samples += plate.wells()[:NUM_SAMPLES]
+        samples_multi += plate.rows()[0][:num_cols]
+        if pcr_384 == True:
+            r, c = p // 2, p % 2  # Quadrant A1, A2, B1 or B2
+            wells = [(2 * (i % 8) + r, 2 * (i // 8) + c) for i in range(NUM_SAMPLES)]
+            pcr_wells_multi += [qpcr_plate.rows()[r][2 * j + c] for j in range(num_cols)]
+        else:
+            wells = [(i % 8, i // 8) for i in range(NUM_SAMPLES)]
+            pcr_wells_multi += qpcr_plate.rows()[0][:num_cols]
+        pcr_wells += [qpcr_plate.rows()[row][col] for row, col in wells]
+        for i, (row, col) in enumerate(wells):
+            sample_map.append([p + 1, 'ABCDEFGH'[i % 8] + str(i // 8 + 1), 'ABCDEFGHIJKLMNOP'[row] + str(col + 1)])
+    # Divide destination wells in small groups for P300 pipette, plate by plate (MMIX tubes are shared out by plate)
+    dests = [(p, group) for p in range(plates)
+        for group in divide_destinations(pcr_wells[p * NUM_SAMPLES:(p + 1) * NUM_SAMPLES], size_transfer)]
+    if mmix_multichannel == True:
+        strip_plan = [(p, group) for p in range(plates)
+            for group in divide_destinations(pcr_wells_multi[p * num_cols:(p + 1) * num_cols], math.ceil(num_cols * plates / strip_cols))]
+        ctx.comment('MMIX will be aliquoted to ' + str(strip_cols) + ' strip column(s) with ' +
+                    str(volume_mmix * len(strip_plan[0][1]) + strip_dead_volume) + ' ul per tube')
+
+    # Step 3 transfers (index in samples_multi), the STAT columns of every elution plate first, in
+    # runs of columns of the same elution plate (quadrant). A run that would not fit in the 20µl
+    # tips left starts with a pause to replace the racks, so they are never replaced mid-plate
+    transfer_runs = []
+    for j in sorted(range(len(samples_multi)), key = lambda j: j % num_cols + 1 not in priority_columns):
+        if transfer_runs and transfer_runs[-1][-1] // num_cols == j // num_cols:
+            transfer_runs[-1].append(j)
+        else:
+            transfer_runs.append([j])
+    tips20_replacements = 0
+    tips20_left = 96 * len(tips20) - tips20_stamping
+    for transfers in transfer_runs:
+        if 8 * len(transfers) > 96 * len(tips20):
+            raise Exception('The 20µl tips of ' + str(len(transfers)) + ' columns do not fit in the ' +
+                            str(len(tips20)) + ' 20µl tipracks of the deck')
+        if 8 * len(transfers) > tips20_left:
+            tips20_replacements += 1
+            tips20_left = 96 * len(tips20)
+        tips20_left -= 8 * len(transfers)
+    ctx.comment('20µl TIP PLAN: ' + str(tips20_needed) + ' tips in ' + str(len(tips20)) + ' racks (slots ' +
+                ', '.join(tips20_slots[:len(tips20)]) + ')' + (', replaced ' + str(tips20_replacements) +
+                ' time(s) during step 3' if tips20_replacements > 0 else ''))
 
 
     # pipettes
@@ -326,9 +506,22 @@ def run(ctx: protocol_api.ProtocolContext):
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': {p300: 0,
-                   m20: 0}
+                   m20: 0},
+        'maxes': {p300: 96 * len(tips200),
+                  m20: 96 * len(tips20)},
+        'used': {p300: 0,
+                 m20: 0}  # Tips of the tipracks already replaced
     }
 
+    # Sample to well map of the 384 well plate
+    if pcr_384 == True:
+        ctx.comment(str(plates) + ' elution plates with ' + str(NUM_SAMPLES) + ' samples each go to the quadrants of the 384 well plate')
+        if not ctx.is_simulating():
+            with open(folder_path + '/Station_C_qPCR_384_map.csv', 'w', newline = '') as f:
+                writer = csv.writer(f)
+                writer.writerow(['plate', 'elution_well', 'qpcr_well'])
+                writer.writerows(sample_map)
+
     ##########
     # pick up tip and if there is none left, prompt user for a new rack
     def pick_up(pip):
@@ -337,103 +530,226 @@ def run(ctx: protocol_api.ProtocolContext):
             if tip_track['counts'][pip] == tip_track['maxes'][pip]:
                 ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
                 resuming.')
-                pip.reset_tipracks()
-                tip_track['counts'][pip] = 0
+                reset_tips(pip)
 
         if not pip.hw_pipette['has_tip']:
             pip.pick_up_tip()
-    ##########
 
-    ############################################################################
-    # STEP 1: Make Master MIX
-    ############################################################################
-    STEP += 1
-    if STEPS[STEP]['Execute'] == True:
-        start = datetime.now()
-        # Check if among the pipettes, p300_single is installed
-        for source, vol in zip(MMIX_components.reagent_reservoir, MMIX_make[mmix_selection]):
-            pick_up(p300)
-            if (vol + air_gap_vol) > pipette_allowed_capacity: # because 200ul is the maximum volume of the tip we will choose 180
-            # calculate what volume should be transferred in each step
-                vol_list=divide_volume(vol, pipette_allowed_capacity)
-                for vol in vol_list:
-                    move_vol_multichannel(p300, reagent=MMIX_components, source=source, dest=MMIX.reagent_reservoir[0],
-                    vol=vol, air_gap_vol=air_gap_vol, x_offset = x_offset,pickup_height=1,
-                    rinse=False, disp_height=-10,blow_out=True, touch_tip=True)
-            else:
-                move_vol_multichannel(p300, reagent=MMIX_components, source=source, dest=MMIX.reagent_reservoir[0],
-                vol=vol, air_gap_vol=air_gap_vol, x_offset=x_offset,pickup_height=1,
-                rinse=False, disp_height=-10,blow_out=True, touch_tip=True)
-
-            p300.drop_tip()
-            tip_track['counts'][p300]+=1
-
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' +
-                    STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
+    def reset_tips(pip):
+        nonlocal tip_track
+        pip.reset_tipracks()
+        tip_track['used'][pip] += tip_track['counts'][pip]
+        tip_track['counts'][pip] = 0
 
-    ############################################################################
-    # STEP 2: Transfer Master MIX
-    ############################################################################
-    STEP += 1
-    if STEPS[STEP]['Execute'] == True:
-        start = datetime.now()
-        pick_up(p300)
-        used_vol=[]
-        for dest in dests:
-            aspirate_volume=volume_mmix * len(dest) + extra_dispensal
-            [pickup_height,col_change]=calc_height(MMIX, area_section_screwcap, aspirate_volume)
-            used_vol_temp = distribute_custom(p300, volume = volume_mmix,
-                src = MMIX.reagent_reservoir[MMIX.col], dest = dest,
-                waste_pool = MMIX.reagent_reservoir[MMIX.col], pickup_height = pickup_height,
-                extra_dispensal = extra_dispensal)
-            used_vol.append(used_vol_temp)
-        p300.drop_tip()
-        tip_track['counts'][p300]+=1
-        #MMIX.unused_two = MMIX.vol_well
-
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' +
-                    STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
+    ##########
+    # next qPCR plate of a run of queued plates (0 based): a single pause to swap the plates,
+    # replace the MMIX tubes (and strips) and, if they would run out during the plate, the tipracks
+    def swap_plates(q):
+        message = ('qPCR plate ' + str(q + 1) + ' of ' + str(queued_plates) + ': move the qPCR plate to the ' +
+                   'thermocycler, place an empty one on the temperature module and the next elution plate' +
+                   ('s' if plates > 1 else '') + ' in slot' + ('s ' if plates > 1 else ' ') +
+                   ', '.join(source_slots))
+        if STEPS[1]['Execute'] == True:
+            message += ', place empty MMIX tubes' + (' and strips' if mmix_multichannel == True else '') + \
+                       ' and top up the MMIX component tubes'
+        tips_needed = {
+            p300: (len(MMIX_make[mmix_selection]) if STEPS[1]['Execute'] == True else 0) +
+                  (1 if STEPS[2]['Execute'] == True else 0),
+            m20: (8 if STEPS[2]['Execute'] == True and mmix_multichannel == True else 0) +
+                 (8 * len(samples_multi) if STEPS[3]['Execute'] == True else 0)
+        }
+        for pip in [p300, m20]:
+            if tip_track['counts'][pip] + tips_needed[pip] > tip_track['maxes'][pip]:
+                message += ', replace the ' + str(pip.max_volume) + 'µl tipracks'
+                reset_tips(pip)
+        ctx.pause(message + ' before resuming.')
+        MMIX.unused.append(MMIX.vol_well)
+        MMIX.col = 0
+        MMIX.vol_well = MMIX.vol_well_original
 
-    ############################################################################
-    # STEP 3: TRANSFER Samples
-    ############################################################################
+    ##########
+    # every elution plate is served from its own MMIX tubes: changes to the first tube of plate p
+    def plate_mmix(p):
+        if MMIX.col < p * mmix_tubes:
+            MMIX.unused.append(MMIX.vol_well)
+            MMIX.col = p * mmix_tubes
+            MMIX.vol_well = MMIX.vol_well_original
+            ctx.comment('MMIX tube for elution plate ' + str(p + 1) + ': ' + str(MMIX.col))
 
-    STEP += 1
-    if STEPS[STEP]['Execute'] == True:
+    ##########
+    # wait for the temperature module before the first step that uses the qPCR plate
+    def wait_for_tempdeck():
         start = datetime.now()
-        ctx.comment('pcr_wells')
-        #Loop over defined wells
-        for s, d in zip(samples_multi, pcr_wells_multi):
-            pick_up(m20)
-            #Source samples
-            move_vol_multichannel(m20, reagent = Samples, source = s, dest = d,
-            vol = volume_sample, air_gap_vol = air_gap_sample, x_offset = x_offset,
-                   pickup_height = 0.2, disp_height = -10, rinse = False,
-                   blow_out=True, touch_tip=False)
-            m20.drop_tip()
-            tip_track['counts'][m20]+=8
-
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' +
-                    STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
+        tempdeck.await_temperature(temperature)
+        ctx.comment('Temperature module at ' + str(temperature) + ' °C, waited ' + str(datetime.now() - start))
+    ##########
+
+    steps_log = [] # Step times of each qPCR plate
+    used_vol = []
+    try:
+        for q in range(queued_plates):
+            STEP = 0
+            plate_start = datetime.now()
+            journal['plate'] = q + 1
+            if q > 0:
+                swap_plates(q)
+
+            ############################################################################
+            # STEP 1: Make Master MIX
+            ############################################################################
+            STEP += 1
+            if STEPS[STEP]['Execute'] == True:
+                ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
+                ctx.comment('###############################################')
+                journal_step(STEP, STEPS[STEP]['description'])
+                start = datetime.now()
+                # Check if among the pipettes, p300_single is installed
+                for sources, total_vol in zip(component_sources, MMIX_make[mmix_selection]):
+                    pick_up(p300)
+                    left = [total_vol / len(sources)] * len(sources) # Volume in each tube of the component
+                    for tube in MMIX.reagent_reservoir: # Every MMIX tube gets the same share of each component
+                        share = total_vol / len(MMIX.reagent_reservoir)
+                        for k, source in enumerate(sources): # From the first component tube not empty yet
+                            vol = min(share, left[k])
+                            if vol < 0.01:
+                                continue
+                            left[k] -= vol
+                            share -= vol
+                            if (vol + air_gap_vol) > pipette_allowed_capacity: # because 200ul is the maximum volume of the tip we will choose 180
+                            # calculate what volume should be transferred in each step
+                                vol_list=divide_volume(vol, pipette_allowed_capacity)
+                                for vol in vol_list:
+                                    move_vol_multichannel(p300, reagent=MMIX_components, source=source, dest=tube,
+                                    vol=vol, air_gap_vol=air_gap_vol, x_offset = x_offset,pickup_height=1,
+                                    rinse=False, disp_height=-10,blow_out=True, touch_tip=True)
+                            else:
+                                move_vol_multichannel(p300, reagent=MMIX_components, source=source, dest=tube,
+                                vol=vol, air_gap_vol=air_gap_vol, x_offset=x_offset,pickup_height=1,
+                                rinse=False, disp_height=-10,blow_out=True, touch_tip=True)
+
+                    p300.drop_tip()
+                    tip_track['counts'][p300]+=1
+
+                end = datetime.now()
+                time_taken = (end - start)
+                ctx.comment('Step ' + str(STEP) + ': ' +
+                            STEPS[STEP]['description'] + ' took ' + str(time_taken))
+                STEPS[STEP]['Time:'] = str(time_taken)
+                journal_step_end(seconds = round(time_taken.total_seconds(), 3))
+
+            ############################################################################
+            # STEP 2: Transfer Master MIX
+            ############################################################################
+            STEP += 1
+            if STEPS[STEP]['Execute'] == True:
+                ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
+                ctx.comment('###############################################')
+                journal_step(STEP, STEPS[STEP]['description'])
+                wait_for_tempdeck()
+                start = datetime.now()
+                pick_up(p300)
+                if mmix_multichannel == True:
+                    # MMIX is aliquoted to the tubes of each strip column...
+                    for strip, (p, plate_cols) in zip(strip_rack.columns(), strip_plan):
+                        plate_mmix(p)
+                        strip_volume = volume_mmix * len(plate_cols) + strip_dead_volume
+                        for tubes in divide_destinations(strip, math.floor(pipette_allowed_capacity / strip_volume)):
+                            aspirate_volume = strip_volume * len(tubes) + extra_dispensal
+                            [pickup_height,col_change]=calc_height(MMIX, area_section_screwcap, aspirate_volume)
+                            used_vol_temp = distribute_custom(p300, volume = strip_volume,
+                                src = MMIX.reagent_reservoir[MMIX.col], dest = tubes,
+                                waste_pool = MMIX.reagent_reservoir[MMIX.col], pickup_height = pickup_height,
+                                extra_dispensal = extra_dispensal)
+                            used_vol.append(used_vol_temp)
+                    p300.drop_tip()
+                    tip_track['counts'][p300]+=1
+                    # ...and stamped into the qPCR plate columns with the multichannel, always the same tips
+                    pick_up(m20)
+                    for strip, (p, plate_cols) in zip(strip_rack.rows()[0], strip_plan):
+                        for d in plate_cols:
+                            for vol in divide_volume(volume_mmix, m20.max_volume):
+                                move_vol_multichannel(m20, reagent = MMIX, source = strip, dest = d,
+                                vol = vol, air_gap_vol = 0, x_offset = x_offset, pickup_height = 0.5,
+                                rinse = False, disp_height = -2, blow_out = True, touch_tip = False)
+                    m20.drop_tip()
+                    tip_track['counts'][m20]+=8
+                else:
+                    for p, dest in dests:
+                        plate_mmix(p)
+                        aspirate_volume=volume_mmix * len(dest) + extra_dispensal
+                        [pickup_height,col_change]=calc_height(MMIX, area_section_screwcap, aspirate_volume)
+                        used_vol_temp = distribute_custom(p300, volume = volume_mmix,
+                            src = MMIX.reagent_reservoir[MMIX.col], dest = dest,
+                            waste_pool = MMIX.reagent_reservoir[MMIX.col], pickup_height = pickup_height,
+                            extra_dispensal = extra_dispensal)
+                        used_vol.append(used_vol_temp)
+                    p300.drop_tip()
+                    tip_track['counts'][p300]+=1
+                #MMIX.unused_two = MMIX.vol_well
+
+                end = datetime.now()
+                time_taken = (end - start)
+                ctx.comment('Step ' + str(STEP) + ': ' +
+                            STEPS[STEP]['description'] + ' took ' + str(time_taken))
+                STEPS[STEP]['Time:'] = str(time_taken)
+                journal_step_end(seconds = round(time_taken.total_seconds(), 3))
+
+            ############################################################################
+            # STEP 3: TRANSFER Samples
+            ############################################################################
+
+            STEP += 1
+            if STEPS[STEP]['Execute'] == True:
+                ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
+                ctx.comment('###############################################')
+                journal_step(STEP, STEPS[STEP]['description'])
+                wait_for_tempdeck() # Returns at once if step 2 already waited
+                start = datetime.now()
+                ctx.comment('pcr_wells')
+                #Loop over defined wells, elution plate by elution plate with the STAT columns first
+                for transfers in transfer_runs:
+                    if tip_track['counts'][m20] + 8 * len(transfers) > tip_track['maxes'][m20]:
+                        ctx.pause('Replace the 20µl tipracks in slot' + ('s ' if len(tips20) > 1 else ' ') +
+                                  ', '.join(tips20_slots[:len(tips20)]) + ' before transferring elution plate ' +
+                                  str(transfers[0] // num_cols + 1) + ', then resume.')
+                        reset_tips(m20)
+                    for s, d in [(samples_multi[j], pcr_wells_multi[j]) for j in transfers]:
+                        pick_up(m20)
+                        #Source samples
+                        move_vol_multichannel(m20, reagent = Samples, source = s, dest = d,
+                        vol = volume_sample, air_gap_vol = air_gap_sample, x_offset = x_offset,
+                               pickup_height = 0.2, disp_height = -10, rinse = False,
+                               blow_out=True, touch_tip=False)
+                        m20.drop_tip()
+                        tip_track['counts'][m20]+=8
+
+                end = datetime.now()
+                time_taken = (end - start)
+                ctx.comment('Step ' + str(STEP) + ': ' +
+                            STEPS[STEP]['description'] + ' took ' + str(time_taken))
+                STEPS[STEP]['Time:'] = str(time_taken)
+                journal_step_end(seconds = round(time_taken.total_seconds(), 3))
+
+            steps_log.append((q, {key: dict(STEPS[key]) for key in STEPS}))
+            if queued_plates > 1:
+                ctx.comment('qPCR plate ' + str(q + 1) + ' of ' + str(queued_plates) + ' took ' +
+                            str(datetime.now() - plate_start))
+    except Exception as e:
+        journal_event('run_error', error = type(e).__name__ + ': ' + str(e))
+        raise
+    finally:
+        journal_close()
 
     # Export the time log to a tsv file
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
             f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
-            for key in STEPS.keys():
-                row = str(key)
-                for key2 in STEPS[key].keys():
-                    row += '\t' + format(STEPS[key][key2])
-                f.write(row + '\n')
+            for q, steps in steps_log:
+                for key in steps.keys():
+                    row = str(key) if queued_plates == 1 else str(q + 1) + '.' + str(key)
+                    for key2 in steps[key].keys():
+                        row += '\t' + format(steps[key][key2])
+                    f.write(row + '\n')
         f.close()
 
     ############################################################################
@@ -457,13 +773,13 @@ def run(ctx: protocol_api.ProtocolContext):
         total_needed_volume = total_used_vol
         ctx.comment('Total Master Mix used volume is: ' + str(total_used_vol) + '\u03BCl.')
         ctx.comment('Needed Master Mix volume is ' +
-                    str(total_needed_volume + extra_dispensal*len(dests)) +'\u03BCl')
+                    str(total_needed_volume + extra_dispensal*len(dests)*queued_plates) +'\u03BCl')
         ctx.comment('Used Master Mix volumes per run are: ' + str(used_vol) + '\u03BCl.')
         ctx.comment('Master Mix Volume remaining in tubes is: ' +
-                    format(np.sum(MMIX.unused)+extra_dispensal*len(dests)+MMIX.vol_well) + '\u03BCl.')
-        ctx.comment('200 ul Used tips in total: ' + str(tip_track['counts'][p300]))
-        ctx.comment('200 ul Used racks in total: ' + str(tip_track['counts'][p300] / 96))
+                    format(np.sum(MMIX.unused)+extra_dispensal*len(dests)*queued_plates+MMIX.vol_well) + '\u03BCl.')
+        ctx.comment('200 ul Used tips in total: ' + str(tip_track['used'][p300] + tip_track['counts'][p300]))
+        ctx.comment('200 ul Used racks in total: ' + str((tip_track['used'][p300] + tip_track['counts'][p300]) / 96))
 
     if STEPS[2]['Execute'] == True:
-        ctx.comment('20 ul Used tips in total: ' + str(tip_track['counts'][m20]))
-        ctx.comment('20 ul Used racks in total: ' + str(tip_track['counts'][m20] / 96))
+        ctx.comment('20 ul Used tips in total: ' + str(tip_track['used'][m20] + tip_track['counts'][m20]))
+        ctx.comment('20 ul Used racks in total: ' + str((tip_track['used'][m20] + tip_track['counts'][m20]) / 96))
@@ -7,7 +7,7 @@ import os
 import numpy as np
 from timeit import default_timer as timer
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import csv
 
 # metadata
@@ -15,7 +15,7 @@ metadata = {
     'protocolName': 'S2 Station B Version 4',
     'author': 'Aitor Gastaminza & José Luis Villanueva & Alex Gasulla',
     'source': 'Hospital Clínic Barcelona & HU Vall Hebrón',
-    'apiLevel': '2.1',
+    'apiLevel': '2.3',
     'description': 'Protocol for RNA extraction'
 }
 
@@ -23,6 +23,13 @@ NUM_SAMPLES = 8
 sample_volume = 200 # Sample volume received in station A
 set_temp_on = False # Do you want to start temperature module?
 recycle_tip = False # Do you want to recycle tips? It shoud only be set True for testing
+tip_parking = False # Do you want to park the tips of each column to reuse them when removing its supernatant?
+multi_dispense = False # Do you want to distribute wash buffers from the top with one tip set and mix each column with the tips that later remove its supernatant?
+waste_volume = 180000 # Volume (µl) the waste reservoir can take before it has to be emptied
+second_waste = False # Do you want to place a second waste reservoir in slot 10 instead of a tiprack?
+queued_plates = 1 # Plates processed back to back in one run, with a pause to swap them
+control_volume = 0 # Internal control (µl per sample) premixed into the lysis reservoir instead of added in station A
+priority_columns = [] # STAT lane: columns (1 based) with priority samples from station A, transferred first to the elution plate
 
 #mag_height = 11 # Height needed for NUNC deepwell in magnetic deck
 mag_height = 14 # Height needed for NEST deepwell in magnetic deck
@@ -35,6 +42,8 @@ multi_well_rack_area = 8 * 71 #Cross section of the 12 well reservoir
 deepwell_cross_section_area = L_deepwell ** 2 # deepwell square cross secion area
 
 num_cols = math.ceil(NUM_SAMPLES / 8) # Columns we are working on
+col_order = ([c - 1 for c in priority_columns if c <= num_cols] + # STAT columns go first
+             [c for c in range(num_cols) if c + 1 not in priority_columns])
 
 def run(ctx: protocol_api.ProtocolContext):
 
@@ -42,7 +51,6 @@ def run(ctx: protocol_api.ProtocolContext):
     gpio.set_button_light(1,0,0)
 
     ctx.comment('Actual used columns: '+str(num_cols))
-    STEP = 0
     STEPS = { #Dictionary with STEP activation, description, and times
             1:{'Execute': False, 'description': 'Mix beads'},# REMOVE
             2:{'Execute': True, 'description': 'Transfer lysis'},#
@@ -75,10 +83,87 @@ def run(ctx: protocol_api.ProtocolContext):
             os.mkdir(folder_path)
         file_path=folder_path+'/time_log.json'"""
 
+    ##########
+    # Event journal: one json line per command and per step boundary, timed with the monotonic
+    # clock from the start of the run. It is only written on the robot.
+    journal = {'file': None, 'buffer': [], 'start': time.monotonic(), 'plate': 1, 'step': 0, 'running': []}
+
+    def journal_event(event, t = None, **data):
+        record = {'t': round((time.monotonic() if t is None else t) - journal['start'], 3), 'event': event,
+                  'plate': journal['plate'], 'step': journal['step']}
+        record.update({key: value for key, value in data.items() if value is not None})
+        journal['buffer'].append(json.dumps(record, default = str))
+
+    def journal_flush():
+        '''
+        Writes the buffered records at once. It is done at step boundaries and pauses, while the
+        robot stands still, so that writing to the SD card does not stall a movement. Only whole
+        lines are written and synced, so a run that aborts leaves a valid journal up to its last flush
+        '''
+        if journal['file'] is not None and journal['buffer']:
+            journal['file'].write('\n'.join(journal['buffer']) + '\n')
+            journal['file'].flush()
+            os.fsync(journal['file'].fileno())
+        journal['buffer'] = []
+
+    def journal_command(message):
+        '''
+        Broker callback of every command: the record is buffered when the command ends, with the
+        time it started, its duration and the well and volume it used
+        '''
+        if message['$'] == 'before':
+            journal['running'].append(time.monotonic())
+            if message['name'] == 'command.PAUSE':
+                journal_flush()
+            return
+        start = journal['running'].pop() if journal['running'] else time.monotonic()
+        payload = message['payload']
+        location = payload.get('location')
+        if location is not None and hasattr(location, 'labware'):
+            location = location.labware # A Location is a point and the well it refers to
+        journal_event('command', t = start, name = message['name'].split('.')[-1].lower(),
+                      seconds = round(time.monotonic() - start, 3), well = str(location) if location is not None else None,
+                      volume = payload.get('volume'), text = payload.get('text'))
+
+    def journal_step(step, description):
+        '''
+        Step boundary: the records so far are written and the next ones belong to step
+        '''
+        journal_flush()
+        journal['step'] = step
+        journal_event('step_start', description = description)
+
+    def journal_step_end(**stats):
+        journal_event('step_end', **stats)
+        journal_flush()
+        journal['step'] = 0 # Pauses and swaps between steps
+
+    def journal_close():
+        '''
+        Ends the journal with the run_end record, closes it and stops listening to the commands.
+        Called from a finally clause, so the journal of a run that raises is also complete
+        '''
+        journal_event('run_end', seconds = round(time.monotonic() - journal['start'], 3))
+        journal_flush()
+        if journal['file'] is not None:
+            journal_unsubscribe()
+            journal['file'].close()
+            journal['file'] = None
+
+    journal_unsubscribe = None
+    if not ctx.is_simulating():
+        if not os.path.isdir('/var/lib/jupyter/notebooks'):
+            os.mkdir('/var/lib/jupyter/notebooks')
+        journal['file'] = open('/var/lib/jupyter/notebooks/Station_B_journal_' + datetime.now().strftime('%Y%m%d_%H%M%S') + '.jsonl', 'w')
+        journal_unsubscribe = ctx.broker.subscribe('command', journal_command) # Every command of the run
+    journal_event('run_start', protocol = metadata['protocolName'], NUM_SAMPLES = NUM_SAMPLES,
+                  date = datetime.now().isoformat())
+
     #Define Reagents as objects with their properties
     class Reagent:
         def __init__(self, name, flow_rate_aspirate, flow_rate_dispense, flow_rate_aspirate_mix, flow_rate_dispense_mix,
-        air_gap_vol_bottom, air_gap_vol_top, disposal_volume, rinse, max_volume_allowed, reagent_volume, reagent_reservoir_volume, num_wells, h_cono, v_fondo, tip_recycling = 'none'):
+        air_gap_vol_bottom, air_gap_vol_top, disposal_volume, rinse, max_volume_allowed, reagent_volume, reagent_reservoir_volume, num_wells, h_cono, v_fondo, tip_recycling = 'none',
+        prewet = 'always', prewet_rounds = 20):
             self.name = name
             self.flow_rate_aspirate = flow_rate_aspirate
             self.flow_rate_dispense = flow_rate_dispense
@@ -98,6 +183,9 @@ def run(ctx: protocol_api.ProtocolContext):
             self.v_cono = v_fondo
             self.tip_recycling = tip_recycling
             self.vol_well_original = reagent_reservoir_volume / num_wells
+            self.prewet = prewet # When tips are rinsed before aspirating: 'always', 'new_tip', 'new_column' or 'never'
+            self.prewet_rounds = prewet_rounds
+            self.last_prewet = None # Tip set or reservoir column of the last rinse
 
     #Reagents and their characteristics
     Lysis = Reagent(name = 'Lysis',
@@ -110,12 +198,13 @@ def run(ctx: protocol_api.ProtocolContext):
                     disposal_volume = 1,
                     rinse = True,
                     max_volume_allowed = 180,
-                    reagent_volume = 530, # reagent volume needed per sample
-                    reagent_reservoir_volume =  (NUM_SAMPLES + 5) * 530, #70000, #51648
-                    num_wells = math.ceil((NUM_SAMPLES + 5) * 530 / 13000), #num_Wells max is 4, 13000 is the reservoir max volume (eventhough reservoir allows 15000)
+                    reagent_volume = 530 + control_volume, # reagent volume needed per sample, premixed internal control included
+                    reagent_reservoir_volume =  (NUM_SAMPLES + 5) * (530 + control_volume), #70000, #51648
+                    num_wells = math.ceil((NUM_SAMPLES + 5) * (530 + control_volume) / 13000), #num_Wells max is 4, 13000 is the reservoir max volume (eventhough reservoir allows 15000)
                     h_cono = 1.95,
                     v_fondo = 750, #1.95 * multi_well_rack_area / 2, #Prismatic
-                    tip_recycling = 'A1')
+                    tip_recycling = 'A1',
+                    prewet = 'new_tip')
 
     VHB = Reagent(name = 'VHB',
                     flow_rate_aspirate = 3,
@@ -207,16 +296,6 @@ def run(ctx: protocol_api.ProtocolContext):
     Water.vol_well = Water.vol_well_original
     Elution.vol_well = 350 # Arbitrary value
 
-    ctx.comment(' ')
-    ctx.comment('###############################################')
-    ctx.comment('VOLUMES FOR ' + str(NUM_SAMPLES) + ' SAMPLES')
-    ctx.comment(' ')
-    ctx.comment('Lysis: ' + str(Lysis.num_wells) + ' wells from well 1 in reservoir 1 with volume ' + str(Lysis.vol_well_original) + ' uL each one')
-    ctx.comment('WH1: ' + str(VHB.num_wells) + ' wells from well 5 in reservoir 1 with volume ' + str(VHB.vol_well_original) + ' uL each one')
-    ctx.comment('WH2: ' + str(SPR.num_wells) + ' wells from well 9 in reservoir 1 with volume ' + str(SPR.vol_well_original) + ' uL each one')
-    ctx.comment('Water: ' + str(Water.num_wells) + ' wells from well 1 in reservoir 2 with volume ' + str(Water.vol_well_original) + ' uL each one')
-    ctx.comment('###############################################')
-    ctx.comment(' ')
 
     ###################
     #Custom functions
@@ -235,41 +314,101 @@ def run(ctx: protocol_api.ProtocolContext):
         if blow_out == True:
             pipet.blow_out(location.top(z = -2)) # Blow out
 
-    def calc_height(reagent, cross_section_area, aspirate_volume):
-        nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well < aspirate_volume:
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-            reagent.vol_well = reagent.vol_well_original
-            ctx.comment('New volume:' + str(reagent.vol_well))
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-                    #- reagent.h_cono
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Remaining volume:' + str(reagent.vol_well))
-            if height < 5:
-                height = 1
-            col_change = True
-        else:
-            height = (reagent.vol_well - aspirate_volume - reagent.v_cono) / cross_section_area
-            reagent.vol_well = reagent.vol_well - aspirate_volume
-            ctx.comment('Calculated height is ' + str(height))
-            if height < 5:
-                height = 1
-            ctx.comment('Used height is ' + str(height))
-            col_change = False
-        return height, col_change
+    def schedule_transfers(reagent, cross_section_area, volumes, col, vol_well):
+        '''
+        Computes the aspirations of a step starting from reservoir column col with vol_well
+        left in it. volumes holds the volume taken from the reservoir (8 channels) by each
+        aspiration, in order. A reservoir column is used until the next aspiration does not
+        fit in what is left in it. Returns NumPy arrays with the reservoir column, pickup height,
+        volume per channel and column change of each aspiration, and the final column and volume
+        '''
+        volumes = np.asarray(volumes, dtype = float)
+        used = np.cumsum(volumes) # Volume taken from the reservoir after each aspiration
+        cols = np.zeros(len(volumes), dtype = int)
+        left = np.zeros(len(volumes)) # Volume left in the reservoir column after each aspiration
+        change = np.zeros(len(volumes), dtype = bool)
+        base = 0 # Volume taken from the reservoir before the current column run
+        start = 0
+        while start < len(volumes):
+            end = int(np.searchsorted(used, base + vol_well + 1e-6, side = 'right')) # Aspirations that fit (with rounding tolerance)
+            if end == start: # Next column should be picked
+                col = col + 1
+                vol_well = reagent.vol_well_original
+                change[start] = True
+                end = max(start + 1, int(np.searchsorted(used, base + vol_well + 1e-6, side = 'right')))
+            cols[start:end] = col
+            left[start:end] = vol_well - (used[start:end] - base)
+            vol_well = left[end - 1]
+            base = used[end - 1]
+            start = end
+        height = (left - reagent.v_cono) / cross_section_area
+        height[height < 5] = 1
+        return {'col': cols, 'height': height, 'volume': volumes / 8, 'change': change,
+            'end_col': int(col), 'end_vol_well': float(vol_well)}
+
+    def plan_transfers(reagent, cross_section_area, volumes):
+        '''
+        Plans all the aspirations of a step before any motion starts (see schedule_transfers),
+        and leaves reagent.col and reagent.vol_well as they will be once the schedule has been
+        executed
+        '''
+        schedule = schedule_transfers(reagent, cross_section_area, volumes, reagent.col, reagent.vol_well)
+        reagent.col = schedule['end_col']
+        reagent.vol_well = schedule['end_vol_well']
+        if reagent.col >= len(reagent.reagent_reservoir):
+            raise Exception(reagent.name + ' needs ' + str(reagent.col + 1) + ' reservoir columns but only ' +
+                str(len(reagent.reagent_reservoir)) + ' are available')
+        if len(volumes) > 0:
+            ctx.comment(reagent.name + ': ' + str(len(volumes)) + ' aspirations planned from reservoir column ' +
+                str(schedule['col'][0]) + ' to ' + str(schedule['col'][-1]))
+        return schedule
+
+    def transfer_volumes(reagent, disposal_volume):
+        '''
+        Volumes (per channel) of the trips that add reagent.reagent_volume to a column without
+        going over reagent.max_volume_allowed, disposal_volume included
+        '''
+        trips = math.ceil(reagent.reagent_volume / reagent.max_volume_allowed)
+        return [reagent.reagent_volume / trips + disposal_volume] * trips
+
+    def wash_trips(reagent, vol_well):
+        '''
+        Splits the distribution of reagent.reagent_volume to every column into trips, starting
+        with vol_well left in the reservoir column. Each trip is filled up to max_volume_allowed
+        and serves as many columns as it can. Returns the volume aspirated (disposal volume not
+        included) and the (column, volume) dispenses of each trip
+        '''
+        capacity = reagent.max_volume_allowed - reagent.disposal_volume
+        pending = [[i, reagent.reagent_volume] for i in range(num_cols)] # Volume each column still needs
+        trips = []
+        while len(pending) > 0:
+            trip = []
+            load = 0
+            trip_capacity = capacity
+            if vol_well / 8 - reagent.disposal_volume >= 20: # Use up the reservoir column before changing to the next one
+                trip_capacity = min(capacity, vol_well / 8 - reagent.disposal_volume)
+            while len(pending) > 0 and trip_capacity - load >= 1: # Avoid dispensing less than 1 ul
+                vol = min(pending[0][1], trip_capacity - load)
+                trip.append((pending[0][0], vol))
+                load += vol
+                pending[0][1] -= vol
+                if pending[0][1] < 0.01:
+                    pending.pop(0)
+            if vol_well < (load + reagent.disposal_volume) * 8:
+                vol_well = reagent.vol_well_original
+            vol_well -= (load + reagent.disposal_volume) * 8
+            trips.append((load, trip))
+        return trips
 
     def move_vol_multi(pipet, reagent, source, dest, vol, x_offset_source, x_offset_dest, pickup_height, rinse, avoid_droplet, wait_time, blow_out):
-        # Rinse before aspirating
-        if rinse == True:
+        # Rinse before aspirating, as often as the reagent pre-wet policy asks for
+        if rinse == True and prewet_due(reagent, source) == True:
+            start = time.monotonic()
             #pipet.aspirate(air_gap_vol_top, location = source.top(z = -5), rate = reagent.flow_rate_aspirate) #air gap
-            custom_mix(pipet, reagent, location = source, vol = vol, rounds = 20, blow_out = False, mix_height = 0, offset = 0)
+            custom_mix(pipet, reagent, location = source, vol = vol, rounds = reagent.prewet_rounds, blow_out = False, mix_height = 0, offset = 0)
             #pipet.dispense(air_gap_vol_top, location = source.top(z = -5), rate = reagent.flow_rate_dispense)
+            step_stats['prewets'] += 1
+            step_stats['prewet_time'] += time.monotonic() - start
 
         # SOURCE
         if reagent.air_gap_vol_top != 0: #If there is air_gap_vol, switch pipette to slow speed
@@ -286,7 +425,7 @@ def run(ctx: protocol_api.ProtocolContext):
             #pipet.aspirate(air_gap_vol_bottom, source.top(z = -5), rate = reagent.flow_rate_aspirate) #air gap
 
         if wait_time != 0:
-            ctx.delay(seconds=wait_time, msg='Waiting for ' + str(wait_time) + ' seconds.')
+            delay(seconds=wait_time, msg='Waiting for ' + str(wait_time) + ' seconds.')
 
         if avoid_droplet == True: # Touch the liquid surface to avoid droplets
             ctx.comment("Moving to: " + str(pickup_height))
@@ -297,7 +436,7 @@ def run(ctx: protocol_api.ProtocolContext):
         pipet.dispense(vol - reagent.disposal_volume + reagent.air_gap_vol_bottom, d, rate = reagent.flow_rate_dispense)
 
         if wait_time != 0:
-            ctx.delay(seconds=wait_time, msg='Waiting for ' + str(wait_time) + ' seconds.')
+            delay(seconds=wait_time, msg='Waiting for ' + str(wait_time) + ' seconds.')
 
         if reagent.air_gap_vol_top != 0:
             pipet.dispense(reagent.air_gap_vol_top, dest.top(z = 0), rate = reagent.flow_rate_dispense)
@@ -310,17 +449,43 @@ def run(ctx: protocol_api.ProtocolContext):
         #    pipet.air_gap(reagent.air_gap_vol_bottom) #air gap
             #pipet.aspirate(air_gap_vol_bottom, dest.top(z = 0),rate = reagent.flow_rate_aspirate) #air gap
 
+    def prewet_due(reagent, source):
+        '''
+        Decides if the tips have to be rinsed in source before aspirating reagent, following
+        reagent.prewet: 'always', once per tip set ('new_tip'), once per reservoir column
+        ('new_column') or 'never'
+        '''
+        if reagent.prewet == 'always':
+            return True
+        elif reagent.prewet == 'new_tip':
+            key = current_tip['id']
+        elif reagent.prewet == 'new_column':
+            key = source
+        else:
+            return False
+        if reagent.last_prewet == key:
+            return False
+        reagent.last_prewet = key
+        return True
+
     ##########
     # pick up tip and if there is none left, prompt user for a new rack
+    current_tip = {'id': 0} # Changes every time a tip set is picked up
     def pick_up(pip):
         nonlocal tip_track
         #if not ctx.is_simulating():
         if tip_track['counts'][pip] >= tip_track['maxes'][pip]:
-            ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-            resuming.')
-            pip.reset_tipracks()
-            tip_track['counts'][pip] = 0
+            swap_tipracks(pip)
         pip.pick_up_tip()
+        current_tip['id'] += 1
+
+    def swap_tipracks(pip):
+        nonlocal tip_track
+        ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
+        resuming.')
+        pip.reset_tipracks()
+        tip_track['used'][pip] += tip_track['counts'][pip]
+        tip_track['counts'][pip] = 0
 
     ##########
     def find_side(col):
@@ -330,6 +495,398 @@ def run(ctx: protocol_api.ProtocolContext):
             side = 1 # right
         return side
 
+    ##########
+    # drop tip (or return it when recycling) and update the tip counters
+    def drop(pip, count = True):
+        nonlocal tip_track
+        if recycle_tip == True:
+            pip.return_tip()
+        else:
+            pip.drop_tip(home_after = False)
+        if count == True: # Parked tips were already counted when parked
+            tip_track['counts'][pip] += 8
+            step_stats['tips'] += 8
+
+    ##########
+    # Tip parking: the tips used to add a reagent to a column are parked in the same
+    # column of the parking rack and reused to remove the supernatant of that column
+    parked_tips = {}
+
+    def park(pip, reagent, col, home = None):
+        '''
+        Parks the tips in column col of the parking rack, or back in home, the tiprack well
+        they were picked up from, if there is no parking rack. They are dropped as usual if
+        there is nowhere to park them, the reagent does not allow it (tip_recycling = 'none')
+        or the column has tips parked already
+        '''
+        nonlocal tip_track
+        if tip_plan['parking'] == True:
+            home = parking_rack.rows()[0][col]
+        if home is None or reagent.tip_recycling == 'none' or col in parked_tips:
+            drop(pip)
+            return
+        pip.drop_tip(home, home_after = False)
+        parked_tips[col] = home
+        tip_track['counts'][pip] += 8
+        step_stats['tips'] += 8
+
+    def pick_up_parked(pip, col):
+        '''
+        Picks up the tips parked for column col, or new ones if there are none.
+        Returns True if the parked tips were picked up
+        '''
+        if col in parked_tips:
+            pip.pick_up_tip(parked_tips.pop(col))
+            current_tip['id'] += 1
+            return True
+        if not pip.hw_pipette['has_tip']:
+            pick_up(pip)
+        return False
+
+    def pick_up_from_rack(pip):
+        '''
+        Picks up new tips like pick_up and returns the tiprack well they come from, so that
+        they can be parked back in it
+        '''
+        if tip_track['counts'][pip] >= tip_track['maxes'][pip]:
+            swap_tipracks(pip)
+        home = [tip for tip in (rack.next_tip(pip.channels) for rack in pip.tip_racks) if tip is not None][0]
+        pip.pick_up_tip(home)
+        current_tip['id'] += 1
+        return home
+
+    ##########
+    # Step engine
+    step_stats = {'tips': 0, 'delay': 0, 'prewets': 0, 'prewet_time': 0} # Statistics of the step being executed
+
+    def delay(seconds, msg):
+        '''
+        Same as ctx.delay, but the waited seconds are added to the delay time of the running step
+        '''
+        step_stats['delay'] += seconds
+        ctx.delay(seconds = seconds, msg = msg)
+
+    def incubation_wait(step, seconds, msg):
+        '''
+        Waits an incubation time. If the tip or waste plans place a tiprack swap or a waste
+        emptying in this step they are done now, while the plate incubates, and the time they
+        took is discounted from the wait
+        '''
+        if step.get('tip_swap', False) == True:
+            start = time.monotonic()
+            swap_tipracks(m300)
+            seconds = max(seconds - (time.monotonic() - start), 0)
+        if step.get('waste_empty') is not None:
+            start = time.monotonic()
+            empty_waste(step['waste_empty'])
+            seconds = max(seconds - (time.monotonic() - start), 0)
+        if seconds > 0:
+            delay(seconds = seconds, msg = msg)
+
+    def run_steps(steps, step_functions):
+        '''
+        Executes in order every STEP activated in steps by calling step_functions[STEP]
+        with its dictionary. Duration (monotonic clock), used tips, delay time and the tip
+        rinses done (number and time) are stored in the STEP dictionary as 'Time:', 'duration',
+        'tips', 'delay_time', 'prewets' and 'prewet_time'
+        '''
+        for STEP in sorted(steps):
+            if steps[STEP]['Execute'] == True:
+                for stat in step_stats:
+                    step_stats[stat] = 0
+                ctx.comment(' ')
+                ctx.comment('###############################################')
+                ctx.comment('Step '+str(STEP)+': '+steps[STEP]['description'])
+                ctx.comment('###############################################')
+                ctx.comment(' ')
+                journal_step(STEP, steps[STEP]['description'])
+                start = time.monotonic()
+                if steps[STEP].get('waste_empty') is not None and 'wait_time' not in steps[STEP]:
+                    empty_waste(steps[STEP]['waste_empty']) # No incubation to do it in
+                step_functions[STEP](steps[STEP])
+                time_taken = time.monotonic() - start
+                steps[STEP]['Time:'] = str(timedelta(seconds = time_taken))
+                steps[STEP]['duration'] = time_taken
+                steps[STEP]['tips'] = step_stats['tips']
+                steps[STEP]['delay_time'] = step_stats['delay']
+                steps[STEP]['prewets'] = step_stats['prewets']
+                steps[STEP]['prewet_time'] = step_stats['prewet_time']
+                journal_step_end(seconds = round(time_taken, 3), tips = step_stats['tips'], delay_time = step_stats['delay'],
+                                 prewets = step_stats['prewets'])
+                ctx.comment('Step ' + str(STEP) + ': ' + steps[STEP]['description'] + ' took ' + steps[STEP]['Time:'])
+                ctx.comment('Used tips in total: '+ str(tip_track['used'][m300] + tip_track['counts'][m300]))
+                if step_stats['prewets'] > 0:
+                    ctx.comment('Tip rinses: ' + str(step_stats['prewets']) + ' (' + str(timedelta(seconds = step_stats['prewet_time'])) + ')')
+
+    ##########
+    # Incubation clocks: moment in which each column received its reagent
+    incubation_start = {}
+
+    def start_incubation(col):
+        incubation_start[col] = time.monotonic()
+
+    def wait_for_tempdeck():
+        '''
+        Waits until the temperature module, ramping since it was loaded, reaches temperature
+        '''
+        start = time.monotonic()
+        tempdeck.await_temperature(temperature)
+        ctx.comment('Temperature module at ' + str(temperature) + ' °C, waited ' +
+                    str(timedelta(seconds = time.monotonic() - start)))
+
+    def empty_waste(slot):
+        ctx.pause('Empty the waste reservoir in slot ' + slot + ' and place it back before resuming.')
+
+    ###############################################################################
+    # Waste planner
+    ########
+    # Volume per sample each STEP sends to the waste reservoir
+    STEP_WASTE = {
+        5: Lysis.reagent_volume + sample_volume,
+        9: VHB.reagent_volume,
+        13: SPR.reagent_volume,
+        17: SPR.reagent_volume,
+        }
+
+    def plan_waste():
+        '''
+        Predicts the volume in the waste reservoir after each STEP. When it would go over
+        waste_volume the supernatant goes to the second waste reservoir (once, if there is one)
+        or the reservoir is emptied during the last incubation before, or at the start of the
+        STEP itself if there is no incubation to do it in. Marks those STEPS with 'waste_switch'
+        and 'waste_empty' (slot of the reservoir to empty). STEPS that alone go over
+        waste_volume are reported as overflows
+        '''
+        plan = {'volume': {}, 'switch': None, 'empty': {}, 'overflow': []}
+        slot = '5'
+        volume = 0 # Volume in the waste reservoir in use
+        since_incubation = 0 # Volume sent to it since the last incubation
+        last_incubation = None
+        for STEP in sorted(STEPS):
+            if STEPS[STEP]['Execute'] == True:
+                if 'wait_time' in STEPS[STEP]:
+                    last_incubation = STEP
+                    since_incubation = 0
+                if STEP in STEP_WASTE:
+                    step_volume = STEP_WASTE[STEP] * 8 * num_cols
+                    if step_volume > waste_volume:
+                        plan['overflow'].append(STEP)
+                    if volume > 0 and volume + step_volume > waste_volume:
+                        if second_waste == True and plan['switch'] is None:
+                            plan['switch'] = STEP
+                            slot = '10'
+                            volume = 0
+                            since_incubation = 0
+                            last_incubation = None # Emptying before now would not empty the new reservoir
+                        elif last_incubation is not None and last_incubation not in plan['empty']:
+                            plan['empty'][last_incubation] = slot
+                            volume = since_incubation
+                        else:
+                            plan['empty'][STEP] = slot
+                            volume = 0
+                    volume += step_volume
+                    since_incubation += step_volume
+                    plan['volume'][STEP] = volume
+                    STEPS[STEP]['waste'] = volume
+        if plan['switch'] is not None:
+            STEPS[plan['switch']]['waste_switch'] = True
+        for STEP in plan['empty']:
+            STEPS[STEP]['waste_empty'] = plan['empty'][STEP]
+        ctx.comment('###############################################')
+        ctx.comment('WASTE PLAN: ' + str(round(sum(STEP_WASTE[STEP] * 8 * num_cols for STEP in plan['volume']) / 1000, 1)) +
+                    ' ml of supernatant, ' + str(round(waste_volume / 1000, 1)) + ' ml per waste reservoir')
+        for STEP in plan['volume']:
+            ctx.comment('Step ' + str(STEP) + ': ' + str(round(plan['volume'][STEP] / 1000, 1)) + ' ml in the waste reservoir')
+        if plan['switch'] is not None:
+            ctx.comment('Supernatant goes to the second waste reservoir in slot 10 from step ' + str(plan['switch']))
+        for STEP in sorted(plan['empty']):
+            ctx.comment('Waste reservoir in slot ' + plan['empty'][STEP] + ' will be emptied during step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
+        for STEP in plan['overflow']:
+            ctx.comment('WARNING: step ' + str(STEP) + ' alone sends more than ' + str(round(waste_volume / 1000, 1)) + ' ml to waste')
+        ctx.comment('###############################################')
+        return plan
+
+    ###############################################################################
+    # Tip budget planner
+    ########
+    # Tips used by each STEP (steps not listed use none):
+    # 'new': one tip set per column; 'park': one tip set per column, parked if tip parking is on;
+    # 'wash': like 'park', plus one tip set to distribute the buffer if multi_dispense is on,
+    # in which case the column tips are parked back in their tiprack if there is no parking rack;
+    # 'reuse': the tip set parked for each column, or a new one if nothing was parked
+    tip_slots = ['6', '7', '8', '9', '10', '11']
+    if second_waste == True:
+        tip_slots.remove('10') # Slot 10 holds the second waste reservoir
+    STEP_TIPS = {
+        2: ('park', Lysis),
+        5: ('reuse', Lysis),
+        7: ('wash', VHB),
+        9: ('reuse', VHB),
+        11: ('wash', SPR),
+        13: ('reuse', SPR),
+        15: ('wash', SPR),
+        17: ('reuse', SPR),
+        20: ('new', Water),
+        23: ('new', Elution),
+        }
+
+    def tip_demand(parking):
+        '''
+        Returns the tips each STEP will use with tip parking on or off, and the STEPS during
+        which used tips wait in the tipracks to be reused, when the racks can not be replaced
+        '''
+        demand = {}
+        held = []
+        parked = False
+        in_racks = False # Tips parked back in their tiprack
+        for STEP in sorted(STEPS):
+            demand[STEP] = 0
+            if STEPS[STEP]['Execute'] == True and in_racks == True:
+                held.append(STEP)
+            if STEPS[STEP]['Execute'] == True and STEP in STEP_TIPS:
+                kind, reagent = STEP_TIPS[STEP]
+                if kind != 'reuse' or parked == False:
+                    demand[STEP] = 8 * num_cols
+                if kind == 'wash' and multi_dispense == True:
+                    demand[STEP] += 8
+                if kind == 'reuse':
+                    parked = False
+                    in_racks = False
+                elif kind in ['park', 'wash'] and parking == True and reagent.tip_recycling != 'none':
+                    parked = True
+                elif kind == 'wash' and multi_dispense == True and reagent.tip_recycling != 'none':
+                    parked = True
+                    in_racks = True
+        return demand, held
+
+    def plan_swaps(demand, capacity, used = 0, held = ()):
+        '''
+        Places each tiprack swap in the last incubation STEP (the ones with wait_time, except
+        the held ones, when tips wait in the racks) before the STEP that would run out of tips,
+        starting with used tips already taken from the racks. Returns the planned swap STEPS and
+        the number of swaps that can not be planned and will pause the robot in the middle of a step
+        '''
+        swaps = []
+        unplanned = 0
+        since_incubation = 0 # Tips used since the last incubation
+        last_incubation = None
+        for STEP in sorted(STEPS):
+            if STEPS[STEP]['Execute'] == True:
+                if 'wait_time' in STEPS[STEP] and STEP not in held:
+                    last_incubation = STEP
+                    since_incubation = 0
+                if used + demand[STEP] > capacity:
+                    if last_incubation is not None and last_incubation not in swaps:
+                        swaps.append(last_incubation)
+                        used = since_incubation
+                    else:
+                        unplanned += 1
+                        used -= capacity
+                used += demand[STEP]
+                since_incubation += demand[STEP]
+        return swaps, unplanned
+
+    def plan_tips(used = 0):
+        '''
+        Plans the tips of the run with tip parking as set in tip_parking, so that the run fits in
+        the loaded tipracks, and marks the STEPS in which racks are swapped. Tip parking is never
+        turned on here, as it needs an empty rack in slot 11: the plan only tells if it would save
+        tiprack replacements.
+        used: tips already taken from the loaded racks, by the previous plates of a continuous run
+        '''
+        def plan(parking):
+            demand, held = tip_demand(parking)
+            racks = len(tip_slots) - 1 if parking == True else len(tip_slots) # With tip parking slot 11 is the parking rack
+            swaps, unplanned = plan_swaps(demand, 96 * racks, used, held)
+            return {'parking': parking, 'racks': racks, 'demand': demand, 'swaps': swaps, 'unplanned': unplanned}
+
+        chosen = plan(tip_parking == True)
+        for STEP in STEPS:
+            STEPS[STEP].pop('tip_swap', None)
+        for STEP in chosen['swaps']:
+            STEPS[STEP]['tip_swap'] = True
+        ctx.comment('###############################################')
+        ctx.comment('TIP PLAN: ' + str(sum(chosen['demand'].values())) + ' tips in ' + str(chosen['racks']) +
+                    ' racks, tip parking ' + ('ON' if chosen['parking'] == True else 'OFF'))
+        for STEP in sorted(chosen['demand']):
+            if chosen['demand'][STEP] > 0:
+                ctx.comment('Step ' + str(STEP) + ': ' + str(chosen['demand'][STEP]) + ' tips')
+        for STEP in chosen['swaps']:
+            ctx.comment('Tipracks will be replaced during step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
+        if chosen['unplanned'] > 0:
+            ctx.comment('WARNING: ' + str(chosen['unplanned']) + ' tiprack replacements will pause the robot while pipetting')
+        if tip_parking != True:
+            parked = plan(True)
+            saved = chosen['unplanned'] + len(chosen['swaps']) - parked['unplanned'] - len(parked['swaps'])
+            if saved > 0:
+                ctx.comment('Setting tip_parking = True, with an EMPTY tiprack in slot 11, would save ' + str(saved) +
+                            ' tiprack replacement' + ('s' if saved > 1 else ''))
+        ctx.comment('###############################################')
+        return chosen
+
+    tip_plan = plan_tips()
+
+    ##########
+    # Reservoir layout: each reagent gets as many contiguous columns as its aspirations will
+    # use, in order of use, filling reservoir 1 (slot 2) before reservoir 2 (slot 3)
+    STEP_RESERVOIR = {2: Lysis, 7: VHB, 11: SPR, 15: SPR, 20: Water}
+
+    def reservoir_demand():
+        '''
+        Returns the reservoir columns each reagent needs, in order of use, planning the
+        aspirations of every STEP to be executed as the step itself will do it
+        '''
+        state = {} # Reservoir column and volume left in it for each reagent
+        for STEP in sorted(STEP_RESERVOIR):
+            reagent = STEP_RESERVOIR[STEP]
+            if STEPS[STEP]['Execute'] == True:
+                col, vol_well = state.get(reagent, (reagent.col, reagent.vol_well))
+                if reagent in [VHB, SPR] and multi_dispense == True:
+                    volumes = [(load + reagent.disposal_volume) * 8 for load, trip in wash_trips(reagent, vol_well)]
+                else:
+                    disposal_volume = Elution.disposal_volume if reagent == Water else reagent.disposal_volume
+                    volumes = [transfer_vol * 8 for i in range(num_cols) for transfer_vol in transfer_volumes(reagent, disposal_volume)]
+                schedule = schedule_transfers(reagent, multi_well_rack_area, volumes, col, vol_well)
+                state[reagent] = (schedule['end_col'], schedule['end_vol_well'])
+        return {reagent: state[reagent][0] + 1 for reagent in state}
+
+    def plan_reservoirs():
+        '''
+        Assigns contiguous columns of the two 12 well reservoirs to the reagents and prints the
+        loading sheet. Returns the reservoir, first column and number of columns of each reagent.
+        The run does not start if the reagents do not fit
+        '''
+        layout = {}
+        reservoir = 0
+        first = 0
+        for reagent, columns in reservoir_demand().items():
+            if first + columns > 12: # Continue in the next reservoir
+                reservoir += 1
+                first = 0
+            if reservoir > 1 or columns > 12:
+                raise Exception('Reagents for ' + str(NUM_SAMPLES) + ' samples do not fit in the reservoirs: ' +
+                    reagent.name + ' needs ' + str(columns) + ' columns of ' + str(round(reagent.vol_well_original, 1)) + ' uL')
+            layout[reagent] = (reservoir, first, columns)
+            first += columns
+        ctx.comment(' ')
+        ctx.comment('###############################################')
+        ctx.comment('VOLUMES FOR ' + str(NUM_SAMPLES) + ' SAMPLES')
+        ctx.comment(' ')
+        for reagent, (reservoir, first, columns) in layout.items():
+            ctx.comment(reagent.name + ': ' + str(columns) + ' wells from well ' + str(first + 1) + ' in reservoir ' +
+                        str(reservoir + 1) + ' with volume ' + str(round(reagent.vol_well_original, 1)) + ' uL each one')
+            if reagent == Lysis and control_volume > 0:
+                ctx.comment('    premixed in each well: ' +
+                            str(round(reagent.vol_well_original * (1 - control_volume / Lysis.reagent_volume), 1)) +
+                            ' uL lysis + ' + str(round(reagent.vol_well_original * control_volume / Lysis.reagent_volume, 1)) +
+                            ' uL internal control')
+        ctx.comment('###############################################')
+        ctx.comment(' ')
+        return layout
+
+    reservoir_plan = plan_reservoirs()
+    waste_plan = plan_waste()
+
 ####################################
     # load labware and modules
     ######## 12 well rack
@@ -340,7 +897,7 @@ def run(ctx: protocol_api.ProtocolContext):
     ########## tempdeck
     tempdeck = ctx.load_module('tempdeck', '1')
     if set_temp_on == True:
-        tempdeck.set_temperature(temperature)
+        tempdeck.start_set_temperature(temperature) # Ramps in the background, awaited before step 23
 
 ##################################
     ####### Elution plate - final plate, goes to C
@@ -359,22 +916,33 @@ def run(ctx: protocol_api.ProtocolContext):
     ######## Waste reservoir
     waste_reservoir = ctx.load_labware('nest_1_reservoir_195ml', '5', 'waste reservoir') # Change to our waste reservoir
     waste = waste_reservoir.wells()[0] # referenced as reservoir
+    if second_waste == True:
+        waste_reservoir_2 = ctx.load_labware('nest_1_reservoir_195ml', '10', 'second waste reservoir')
+        waste_2 = waste_reservoir_2.wells()[0]
+        ctx.comment('Place a second empty waste reservoir in slot 10')
 
 ####################################
     ######### Load tip_racks
-    tips300 = [ctx.load_labware('opentrons_96_tiprack_300ul', slot, '200µl filter tiprack')
-        for slot in ['6', '7', '8', '9', '10', '11']]
+    if tip_plan['parking'] == True: # The rack in slot 11 is used to park tips, it must be loaded empty
+        tips300 = [ctx.load_labware('opentrons_96_tiprack_300ul', slot, '200µl filter tiprack')
+            for slot in tip_slots[:-1]]
+        parking_rack = ctx.load_labware('opentrons_96_tiprack_300ul', '11', 'empty tiprack for tip parking')
+        for column in parking_rack.columns():
+            parking_rack.use_tips(column[0], len(column))
+        ctx.comment('Tip parking is on: place an EMPTY 300µl tiprack in slot 11')
+    else:
+        tips300 = [ctx.load_labware('opentrons_96_tiprack_300ul', slot, '200µl filter tiprack')
+            for slot in tip_slots]
     #tips1000 = [ctx.load_labware('opentrons_96_filtertiprack_1000ul', slot, '1000µl filter tiprack')
     #    for slot in ['10']]
 
 ###############################################################################
     #Declare which reagents are in each reservoir as well as deepwell and elution plate
-    Lysis.reagent_reservoir = reagent_res.rows()[0][:4] # 4 columns
+    reservoirs = [reagent_res, reagent_res_2]
+    for reagent, (reservoir, first, columns) in reservoir_plan.items():
+        reagent.reagent_reservoir = reservoirs[reservoir].rows()[0][first:first + columns]
     #Beads_PK.reagent_reservoir = reagent_res.rows()[0][Lysis.num_wells:(Lysis.num_wells+Beads_PK.num_wells)]
-    VHB.reagent_reservoir = reagent_res.rows()[0][4:8]
     #SPR.reagent_reservoir = reagent_res.rows()[0][VHB.num_wells:(Lysis.num_wells + Beads_PK.num_wells + VHB.num_wells + SPR.num_wells)]
-    SPR.reagent_reservoir = reagent_res_2.rows()[0][:8]
-    Water.reagent_reservoir = reagent_res.rows()[0][-1]
     work_destinations = deepwell_plate.rows()[0][:Elution.num_wells]
     final_destinations = elution_plate.rows()[0][:Elution.num_wells]
 
@@ -394,7 +962,8 @@ def run(ctx: protocol_api.ProtocolContext):
     #### used tip counter and set maximum tips available
     tip_track = {
         'counts': {m300: 0},
-        'maxes': {m300: 96 * len(m300.tip_racks)} #96 tips per tiprack * number or tipracks in the layout
+        'maxes': {m300: 96 * len(m300.tip_racks)}, #96 tips per tiprack * number or tipracks in the layout
+        'used': {m300: 0} # Tips of the tipracks already replaced
         }
         #, p1000: len(tips1000)*96}
 
@@ -403,15 +972,8 @@ def run(ctx: protocol_api.ProtocolContext):
     ###############################################################################
     # STEP 1 MIX BEADS
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
+    def mix_beads(step):
     ### PREMIX BEADS
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
         if not m300.hw_pipette['has_tip']:
             pick_up(m300) #These tips are reused in the first transfer of beads
             ctx.comment(' ')
@@ -425,309 +987,105 @@ def run(ctx: protocol_api.ProtocolContext):
         ctx.comment('Finished premixing!')
         ctx.comment('Now, reagents will be transferred to deepwell plate.')
         ctx.comment(' ')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
     # STEP 2 TRANSFER LYSIS
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-    #Transfer lysis
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
+    def transfer_lysis(step):
         # max_volume_allowed = 160 # Tips allow up to 200uL, but we only allow max_volume_allowed
-        lysis_trips = math.ceil(Lysis.reagent_volume / Lysis.max_volume_allowed)
-        lysis_volume = Lysis.reagent_volume / lysis_trips #136.66
-        lysis_transfer_vol = []
-        for i in range(lysis_trips):
-            lysis_transfer_vol.append(lysis_volume + Lysis.disposal_volume)
-        #ctx.comment(print(lysis_transfer_vol))
-        #lysis_transfer_vol = [lysis_volume + Lysis.disposal_volume, lysis_volume + Lysis.disposal_volume, lysis_volume + Lysis.disposal_volume] # Three rounds of 140 + disposal volume
+        lysis_transfer_vol = transfer_volumes(Lysis, Lysis.disposal_volume)
+        lysis_trips = len(lysis_transfer_vol)
         x_offset_source = 0
         x_offset_dest   = 0
         rinse = True
+        incubation_start.clear()
+        #Calculate pickup heights based on remaining volume and shape of container
+        schedule = plan_transfers(Lysis, multi_well_rack_area,
+            [transfer_vol * 8 for i in range(num_cols) for transfer_vol in lysis_transfer_vol])
+        k = 0 # Position in the schedule
         for i in range(num_cols):
             ctx.comment("Column: " + str(i))
             if not m300.hw_pipette['has_tip']:
                 pick_up(m300)
-            for j,transfer_vol in enumerate(lysis_transfer_vol):
-                #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(Lysis, multi_well_rack_area, transfer_vol * 8)
-
-                if change_col == True: #If we switch column because there is not enough volume left in current reservoir column we mix new column
-                    ctx.comment('Mixing new reservoir column: ' + str(Lysis.col))
-                    custom_mix(m300, Lysis, Lysis.reagent_reservoir[Lysis.col],
+            for transfer_vol in schedule['volume'][k:k + lysis_trips]:
+                source = Lysis.reagent_reservoir[schedule['col'][k]]
+                pickup_height = schedule['height'][k]
+                if schedule['change'][k] == True: #If we switch column because there is not enough volume left in current reservoir column we mix new column
+                    ctx.comment('Mixing new reservoir column: ' + str(schedule['col'][k]))
+                    custom_mix(m300, Lysis, source,
                     vol = 180, rounds = 10, blow_out = False, mix_height = 0, offset = 0)
-                ctx.comment('Aspirate from reservoir column: ' + str(Lysis.col))
-                ctx.comment('Pickup height is ' + str(pickup_height))
-                #if j!=0:
-                #    rinse = False
-                move_vol_multi(m300, reagent = Lysis, source = Lysis.reagent_reservoir[Lysis.col],
+                move_vol_multi(m300, reagent = Lysis, source = source,
                 dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = rinse, avoid_droplet = False, wait_time = 2, blow_out = False)
-                #m300.move_to(work_destinations[i].top(0))
-                #m300.air_gap(Lysis.air_gap_vol_bottom) #air gap
-            #m300.aspirate(air_gap_vol_bottom, work_destinations[i].top(10), rate = Lysis.flow_rate_aspirate) #air gap
-            #m300.dispense(disposal_volume + air_gap_vol_bottom, location = Lysis.reagent_reservoir[Lysis.col].top(0), rate = Lysis.flow_rate_dispense)
+                k += 1
+            start_incubation(i) # Lysis incubation of this column starts now
             ctx.comment(' ')
             ctx.comment('Mixing sample ')
             custom_mix(m300, Lysis, location = work_destinations[i], vol = 180,
             rounds = 20, blow_out = False, mix_height = 0, offset = 0)
             m300.move_to(work_destinations[i].top(0))
             m300.air_gap(Lysis.air_gap_vol_bottom) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-            tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
-
-    ###############################################################################
-    # STEP 3 INCUBATING WITHOUT MAGNET
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-    #Transfer magnetic beads
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubating for ' + format(STEPS[STEP]['wait_time']) + ' seconds.') # minutes=2
-        ctx.comment(' ')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 3 TRANSFER MAGNET BEADS
-        ########
-
-    ###############################################################################
-    # STEP 4 INCUBATE WAIT WITH MAGNET ON
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        magdeck.engage(height=mag_height)
-        ctx.comment(' ')
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubating ON magnet for ' + format(STEPS[STEP]['wait_time']) + ' seconds.') # minutes=2
-        ctx.comment(' ')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 4 INCUBATE WAIT WITH MAGNET ON
-        ########
-
-    ###############################################################################
-    # STEP 5 REMOVE SUPERNATANT
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        # remove supernatant -> height calculation can be omitted and referred to bottom!
-        #max_volume_allowed = 190 # Tips allow up to 200uL, but we only allow max_volume_allowed
-        supernatant_trips = math.ceil((Lysis.reagent_volume + sample_volume) / Lysis.max_volume_allowed)
-        supernatant_volume = Lysis.max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
-        #supernatant_volume = (Lysis.reagent_volume + sample_volume) / supernatant_trips #136.66
-        supernatant_transfer_vol = []
-        for i in range(supernatant_trips):
-            supernatant_transfer_vol.append(supernatant_volume + Elution.disposal_volume)
-        #ctx.comment(print(supernatant_transfer_vol))
-        #supernatant_volume = 150
-        #supernatant_vol = [supernatant_volume + Elution.disposal_volume, supernatant_volume + Elution.disposal_volume, supernatant_volume + Elution.disposal_volume, supernatant_volume + Elution.disposal_volume]
-        x_offset_rs = 2
-
-        for i in range(num_cols):
-            x_offset_source = find_side(i) * x_offset_rs
-            x_offset_dest   = 0
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for transfer_vol in supernatant_transfer_vol:
-                #Pickup_height is fixed here
-                pickup_height = 1 # Original 0.5
-                ctx.comment('Aspirate from deep well column: ' + str(i+1))
-                ctx.comment('Pickup height is ' + str(pickup_height) +' (fixed)')
-                move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
-                dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
-                pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 2, blow_out = False)
-                #m300.air_gap(Elution.air_gap_vol_bottom) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-            tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 5 REMOVE SUPERNATANT
-        ########
+            park(m300, Lysis, i)
 
     ###############################################################################
-    # STEP 6 MAGNET OFF
+    # INCUBATION WITH MAGNET OFF (STEPS 3, 18, 21)
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+    def incubate_magnet_off(step):
+        incubation_wait(step, step['wait_time'], msg = 'Incubating OFF magnet for ' + format(step['wait_time']) + ' seconds.')
         ctx.comment(' ')
 
-        # switch off magnet
-        magdeck.disengage()
-
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 6 MAGNET OFF
-        ########
-
     ###############################################################################
-    # STEP 7 VHB/WB1
+    # INCUBATION WITH MAGNET OFF STAGGERED BY COLUMN (STEPS 3, 21)
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+    def incubate_columns(step):
+        '''
+        Every column started incubating when it received its reagent, so only the time
+        the last filled column still needs is waited. The magnet is engaged afterwards
+        '''
+        if len(incubation_start) == 0: # Reagent not added in this run, wait the whole time
+            incubate_magnet_off(step)
+            return
+        now = time.monotonic()
+        remaining = max(step['wait_time'] - (now - max(incubation_start.values())), 0)
+        step['saved_time'] = step['wait_time'] - remaining
+        ctx.comment('Column 1 has been incubating for ' + str(round(now - incubation_start[min(incubation_start)])) +
+                    ' seconds, last column for ' + str(round(step['saved_time'])) + ' seconds')
+        incubation_wait(step, remaining, msg = 'Incubating OFF magnet for ' + format(round(remaining)) + ' more seconds.')
         ctx.comment(' ')
-        #max_volume_allowed = 190 # Tips allow up to 200uL, but we only allow max_volume_allowed
-        vhb_trips = math.ceil(VHB.reagent_volume / VHB.max_volume_allowed)
-        vhb_volume = VHB.reagent_volume / vhb_trips #136.66
-        vhb_transfer_vol = []
-        for i in range(vhb_trips):
-            vhb_transfer_vol.append(vhb_volume + VHB.disposal_volume)
-        #vhb_volume = 166.66
-        #vhb_wash_vol = [vhb_volume + VHB.disposal_volume, vhb_volume + VHB.disposal_volume, vhb_volume + VHB.disposal_volume]
-        x_offset_rs = 2.5
-        rinse = False # Not needed
-
-        ########
-        # whb washes
-        for i in range(num_cols):
-            x_offset_source = 0
-            x_offset_dest   = -1 * find_side(i) * x_offset_rs
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for transfer_vol in vhb_transfer_vol:
-                #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(VHB, multi_well_rack_area, transfer_vol*8)
-                ctx.comment('Aspirate from Reservoir column: ' + str(VHB.col))
-                ctx.comment('Pickup height is ' + str(pickup_height))
-                #if i!=0:
-                #    rinse = False
-                move_vol_multi(m300, reagent = VHB, source = VHB.reagent_reservoir[VHB.col],
-                dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
-                pickup_height = pickup_height, rinse = rinse, avoid_droplet = False, wait_time = 2, blow_out = False)
-                #m300.move_to(work_destinations[i].top(0))
-                #m300.air_gap(VHB.air_gap_vol_bottom) #air gap
-                #m300.aspirate(air_gap_vol_bottom, work_destinations[i].top(10), rate = VHB.flow_rate_aspirate) #air gap
-            custom_mix(m300, VHB, location = work_destinations[i], vol = 180,
-                rounds = 20, blow_out = False, mix_height = 0, offset = x_offset_dest)
-            m300.move_to(work_destinations[i].top(0))
-            m300.air_gap(VHB.air_gap_vol_bottom) #air gap
-            #m300.aspirate(air_gap_vol_bottom, work_destinations[i].top(10), rate = VHB.flow_rate_aspirate) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-            tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 7 ADD VHB
-        ########
 
     ###############################################################################
-    # STEP 8 INCUBATE WAIT WITH MAGNET ON
+    # INCUBATION WITH MAGNET ON (STEPS 4, 8, 12, 16, 22)
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
+    def incubate_magnet_on(step):
+        # switch on magnet
+        magdeck.engage(height = mag_height)
         ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
+        incubation_wait(step, step['wait_time'], msg = 'Incubating ON magnet for ' + format(step['wait_time']) + ' seconds.')
         ctx.comment(' ')
-        # switch on magnet
-        magdeck.engage(mag_height)
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for 5 minutes.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
-        ####################################################################
-        # STEP 8* WAIT FOR 5'
-        ########
 
     ###############################################################################
-    # STEP 9 REMOVE SUPERNATANT
+    # REMOVE SUPERNATANT (STEPS 5, 9, 13, 17)
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
+    def remove_supernatant(step, reagent, volume):
+        '''
+        Removes the supernatant of each column to waste. volume is the liquid per sample
+        to be removed and reagent the one whose max_volume_allowed limits each trip
+        '''
+        nonlocal waste
+        if step.get('waste_switch', False) == True: # Waste plan: the first waste reservoir is full
+            waste = waste_2
         # remove supernatant -> height calculation can be omitted and referred to bottom!
-        #max_volume_allowed = 190 # Tips allow up to 200uL, but we only allow max_volume_allowed
-        supernatant_trips = math.ceil(VHB.reagent_volume / VHB.max_volume_allowed)
-        supernatant_volume = VHB.max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
-        #supernatant_volume = VHB.reagent_volume / supernatant_trips #136.66
+        supernatant_trips = math.ceil(volume / reagent.max_volume_allowed)
+        supernatant_volume = reagent.max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
         supernatant_transfer_vol = []
         for i in range(supernatant_trips):
             supernatant_transfer_vol.append(supernatant_volume + Elution.disposal_volume)
-        #supernatant_vol = [175, 175, 175, 175, 175, 175, 175]
         x_offset_rs = 2
 
         for i in range(num_cols):
             x_offset_source = find_side(i) * x_offset_rs
             x_offset_dest   = 0
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
+            reused = pick_up_parked(m300, i) # Tips parked when the reagent was added to this column
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
                 pickup_height = 1 # Original 0.5
@@ -736,401 +1094,101 @@ def run(ctx: protocol_api.ProtocolContext):
                 move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
                 dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 2, blow_out = False)
-                #m300.air_gap(Elution.air_gap_vol_bottom) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-            tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 9 REMOVE SUPERNATANT
-        ########
+            drop(m300, count = not reused)
 
     ###############################################################################
-    # STEP 10 MAGNET OFF
+    # MAGNET OFF (STEPS 6, 10, 14, 19)
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-
+    def magnet_off(step):
         # switch off magnet
         magdeck.disengage()
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 10 MAGNET OFF
-        ########
-
     ###############################################################################
-    # STEP 11 SPR
+    # ADD WASH BUFFER (STEPS 7, 11, 15)
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
+    def add_wash(step, reagent, mix_offset = 0):
+        '''
+        Adds reagent.reagent_volume of a wash buffer to each column and mixes it.
+        mix_offset is added to the lateral offset used when mixing the sample
+        '''
         #max_volume_allowed = 190 # Tips allow up to 200uL, but we only allow max_volume_allowed
-        spr_trips = math.ceil(SPR.reagent_volume / SPR.max_volume_allowed)
-        spr_volume = SPR.reagent_volume / spr_trips #136.66
-        spr_transfer_vol = []
-        for i in range(spr_trips):
-            spr_transfer_vol.append(spr_volume + SPR.disposal_volume)
-        #spr_volume = 166.66
-        #spr_wash_vol = [spr_volume + SPR.disposal_volume, spr_volume + SPR.disposal_volume, spr_volume + SPR.disposal_volume]
+        wash_transfer_vol = transfer_volumes(reagent, reagent.disposal_volume)
         x_offset_rs = 2.5
-        rinse = False # No rinse needed
-
-        ########
-        # spr washes
-        for i in range(num_cols):
-            x_offset_source = 0
-            x_offset_dest   = -1 * find_side(i) * x_offset_rs
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for transfer_vol in spr_transfer_vol:
-                #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(SPR, multi_well_rack_area, transfer_vol*8)
-                ctx.comment('Aspirate from Reservoir column: ' + str(SPR.col))
-                ctx.comment('Pickup height is ' + str(pickup_height))
-                #if i!=0:
-                #    rinse = False
-                move_vol_multi(m300, reagent = SPR, source = SPR.reagent_reservoir[SPR.col],
-                dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
-                pickup_height = pickup_height, rinse = rinse, avoid_droplet = False, wait_time = 2, blow_out = False)
-                #m300.move_to(work_destinations[i].top(0))
-                #m300.air_gap(SPR.air_gap_vol_bottom) #air gap
-                #m300.aspirate(air_gap_vol_bottom, work_destinations[i].top(10), rate = SPR.flow_rate_aspirate) #air gap
-            custom_mix(m300, VHB, location = work_destinations[i], vol = 180,
-                rounds = 20, blow_out = False, mix_height = 0, offset = x_offset_dest)
-            m300.move_to(work_destinations[i].top(0))
-            m300.air_gap(SPR.air_gap_vol_bottom) #air gap
-            #m300.aspirate(air_gap_vol_bottom, work_destinations[i].top(10), rate = SPR.flow_rate_aspirate) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-            tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 11 ADD SPR
-        ########
-
-    ###############################################################################
-    # STEP 12 INCUBATE WAIT WITH MAGNET ON
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        # switch on magnet
-        magdeck.engage(mag_height)
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for 5 minutes.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ####################################################################
-        # STEP 12* WAIT FOR 5'
-        ########
-
-    ###############################################################################
-    # STEP 13 REMOVE SUPERNATANT
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        # remove supernatant -> height calculation can be omitted and referred to bottom!
-        #max_volume_allowed = 190 # Tips allow up to 200uL, but we only allow max_volume_allowed
-        supernatant_trips = math.ceil(SPR.reagent_volume / SPR.max_volume_allowed)
-        supernatant_volume = SPR.max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
-        #supernatant_volume = SPR.reagent_volume / supernatant_trips #136.66
-        supernatant_transfer_vol = []
-        for i in range(supernatant_trips):
-            supernatant_transfer_vol.append(supernatant_volume + Elution.disposal_volume)
-        #supernatant_vol = [175, 175, 175, 175, 175]
-        x_offset_rs = 2
-
-        for i in range(num_cols):
-            x_offset_source = find_side(i) * x_offset_rs
-            x_offset_dest   = 0
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for transfer_vol in supernatant_transfer_vol:
-                #Pickup_height is fixed here
-                pickup_height = 1 # Original 0.5
-                ctx.comment('Aspirate from deep well column: ' + str(i+1))
-                ctx.comment('Pickup height is ' + str(pickup_height) +' (fixed)')
-                move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
-                dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
-                pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 2, blow_out = False)
-                #m300.air_gap(Elution.air_gap_vol_bottom) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-            tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 13 REMOVE SUPERNATANT
-        ########
-
-    ###############################################################################
-    # STEP 14 MAGNET OFF
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-
-        # switch off magnet
-        magdeck.disengage()
-
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 14 MAGNET OFF
-        ########
+        rinse = False # Not needed
+        if multi_dispense == True: # Buffer is distributed first, then each column is only mixed, with the tips that will remove its supernatant
+            distribute_wash(reagent, x_offset_rs)
+            wash_transfer_vol = []
+        #Calculate pickup heights based on remaining volume and shape of container
+        schedule = plan_transfers(reagent, multi_well_rack_area,
+            [transfer_vol * 8 for i in range(num_cols) for transfer_vol in wash_transfer_vol])
+        k = 0 # Position in the schedule
 
-    ###############################################################################
-    # STEP 15 SPR
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        #max_volume_allowed = 190
-        spr_trips = math.ceil(SPR.reagent_volume / SPR.max_volume_allowed)
-        spr_volume = SPR.reagent_volume / spr_trips #136.66
-        spr_transfer_vol = []
-        for i in range(spr_trips):
-            spr_transfer_vol.append(spr_volume + SPR.disposal_volume)
-        #spr_volume = 166.66
-        #spr_wash_vol = [spr_volume + SPR.disposal_volume, spr_volume + SPR.disposal_volume, spr_volume + SPR.disposal_volume]
-        x_offset_rs = 2.5
-        rinse = False #No rinse needed
         ########
-        # spr washes
+        # washes
         for i in range(num_cols):
             x_offset_source = 0
             x_offset_dest   = -1 * find_side(i) * x_offset_rs
+            home = None # Tiprack well of the column tips with multi_dispense, to park them back
             if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for transfer_vol in spr_transfer_vol:
-                #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(SPR, multi_well_rack_area, transfer_vol*8)
-                ctx.comment('Aspirate from Reservoir column: ' + str(SPR.col))
-                ctx.comment('Pickup height is ' + str(pickup_height))
-                #if i!=0:
-                #    rinse = False
-                move_vol_multi(m300, reagent = SPR, source = SPR.reagent_reservoir[SPR.col],
+                if multi_dispense == True:
+                    home = pick_up_from_rack(m300)
+                else:
+                    pick_up(m300)
+            for transfer_vol in schedule['volume'][k:k + len(wash_transfer_vol)]:
+                move_vol_multi(m300, reagent = reagent, source = reagent.reagent_reservoir[schedule['col'][k]],
                 dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
-                pickup_height = pickup_height, rinse = rinse, avoid_droplet = False, wait_time = 2, blow_out = False)
-                #m300.aspirate(SPR.air_gap_vol_bottom, work_destinations[i].top(10), rate = SPR.flow_rate_aspirate) #air gap
-            custom_mix(m300, VHB, location = work_destinations[i], vol = 180,
-                rounds = 20, blow_out = False, mix_height = 0, offset = x_offset_dest)
+                pickup_height = schedule['height'][k], rinse = rinse, avoid_droplet = False, wait_time = 2, blow_out = False)
+                k += 1
+            custom_mix(m300, reagent, location = work_destinations[i], vol = 180,
+                rounds = 20, blow_out = False, mix_height = 0, offset = x_offset_dest + mix_offset)
             m300.move_to(work_destinations[i].top(0))
-            m300.air_gap(SPR.air_gap_vol_bottom) #air gap
-            #m300.aspirate(air_gap_vol_bottom, work_destinations[i].top(10), rate = SPR.flow_rate_aspirate) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-            tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 15 ADD SPR
-        ########
+            m300.air_gap(reagent.air_gap_vol_bottom) #air gap
+            park(m300, reagent, i, home)
 
     ###############################################################################
-    # STEP 16 INCUBATE WAIT WITH MAGNET ON
+    # DISTRIBUTE WASH BUFFER FROM THE TOP (STEPS 7, 11, 15 when multi_dispense is on)
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        # switch on magnet
-        magdeck.engage(mag_height)
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for 30 seconds.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ####################################################################
-        # STEP 16* WAIT FOR 5'
-        ########
-
-    ###############################################################################
-    # STEP 17 REMOVE SUPERNATANT
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        # remove supernatant -> height calculation can be omitted and referred to bottom!
-        #max_volume_allowed = 190 # Tips allow up to 200uL, but we only allow max_volume_allowed
-        supernatant_trips = math.ceil(SPR.reagent_volume / SPR.max_volume_allowed)
-        supernatant_volume = SPR.max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
-        #supernatant_volume = SPR.reagent_volume / supernatant_trips #136.66
-        supernatant_transfer_vol = []
-        for i in range(supernatant_trips):
-            supernatant_transfer_vol.append(supernatant_volume + Elution.disposal_volume)
-        #supernatant_vol = [175, 175, 175]
-        x_offset_rs = 2
-
-        for i in range(num_cols):
-            x_offset_source = find_side(i) * x_offset_rs
-            x_offset_dest   = 0
-            if not m300.hw_pipette['has_tip']:
-                pick_up(m300)
-            for transfer_vol in supernatant_transfer_vol:
-                #Pickup_height is fixed here
-                pickup_height = 1 # Original 0.5
-                ctx.comment('Aspirate from deep well column: ' + str(i+1))
-                ctx.comment('Pickup height is ' + str(pickup_height) +' (fixed)')
-                move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
-                dest = waste, vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
-                pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 2, blow_out = False)
-                #m300.move_to(waste.top(0))
-                #m300.air_gap(Elution.air_gap_vol_bottom) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-            tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
-        ctx.comment('Used tips in total: ' + str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 17 REMOVE SUPERNATANT
-        ########
-
-    ###############################################################################
-    # STEP 18 ALLOW DRY
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubating OFF magnet for ' + format(STEPS[STEP]['wait_time']) + ' seconds.') # minutes=2
-        ctx.comment(' ')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
-        ctx.comment('Used tips in total: ' + str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 18 ALLOW DRY
-        ########
-
-    ###############################################################################
-    # STEP 19 MAGNET OFF
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-
-        # switch off magnet
-        magdeck.disengage()
-
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
-        ctx.comment('Used tips in total: ' + str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 19 MAGNET OFF
-        ########
+    def distribute_wash(reagent, x_offset_rs):
+        '''
+        Distributes reagent.reagent_volume to every column dispensing from the top, so a
+        single tip set is used. Each aspiration is filled up to max_volume_allowed and
+        serves as many columns as it can; the disposal volume is blown out back in the reservoir
+        '''
+        trips = wash_trips(reagent, reagent.vol_well)
+        #Calculate pickup heights based on remaining volume and shape of container
+        schedule = plan_transfers(reagent, multi_well_rack_area,
+            [(load + reagent.disposal_volume) * 8 for load, trip in trips])
+        if not m300.hw_pipette['has_tip']:
+            pick_up(m300)
+        for k, (load, trip) in enumerate(trips):
+            source = reagent.reagent_reservoir[schedule['col'][k]]
+            m300.aspirate(load + reagent.disposal_volume, source.bottom(schedule['height'][k]))
+            if reagent.air_gap_vol_bottom != 0:
+                m300.move_to(source.top(z = 0))
+                m300.air_gap(reagent.air_gap_vol_bottom) #air gap
+            delay(seconds = 2, msg = 'Waiting for 2 seconds.')
+            air_gap = reagent.air_gap_vol_bottom # Air gap goes out with the first dispense
+            for col, vol in trip:
+                d = work_destinations[col].top(z = -5).move(Point(x = -1 * find_side(col) * x_offset_rs))
+                m300.dispense(vol + air_gap, d, rate = reagent.flow_rate_dispense)
+                air_gap = 0
+            m300.blow_out(source.top(z = -5)) # Disposal volume back to the reservoir
+        drop(m300)
 
     ###############################################################################
     # STEP 20 Transfer water
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
+    def add_water(step):
         #Water elution
         #max_volume_allowed = 190 # Tips allow up to 200uL, but we only allow max_volume_allowed
-        water_trips = math.ceil(Water.reagent_volume / Water.max_volume_allowed)
-        water_volume = Water.reagent_volume / water_trips
-        water_wash_vol = []
-        for i in range(water_trips):
-            water_wash_vol.append(water_volume + Elution.disposal_volume)
-        #water_wash_vol = [50 + Water.disposal_volume]
+        water_wash_vol = transfer_volumes(Water, Elution.disposal_volume)
+        water_trips = len(water_wash_vol)
         x_offset_rs = 2.5
+        incubation_start.clear()
+        #Calculate pickup heights based on remaining volume and shape of container
+        schedule = plan_transfers(Water, multi_well_rack_area,
+            [transfer_vol * 8 for i in range(num_cols) for transfer_vol in water_wash_vol])
+        k = 0 # Position in the schedule
 
         ########
         # Water or elution buffer
@@ -1139,19 +1197,14 @@ def run(ctx: protocol_api.ProtocolContext):
             x_offset_dest   = -1 * find_side(i) * x_offset_rs # Original 0
             if not m300.hw_pipette['has_tip']:
                 pick_up(m300)
-            for transfer_vol in water_wash_vol:
-                #Calculate pickup_height based on remaining volume and shape of container
-                [pickup_height, change_col] = calc_height(Water, multi_well_rack_area, transfer_vol*8)
-                ctx.comment('Aspirate from Reservoir column: ' + str(Water.col))
-                ctx.comment('Pickup height is ' + str(pickup_height))
+            for transfer_vol in schedule['volume'][k:k + water_trips]:
 
-                move_vol_multi(m300, reagent = Water, source = Water.reagent_reservoir,
+                move_vol_multi(m300, reagent = Water, source = Water.reagent_reservoir[schedule['col'][k]],
                 dest = work_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
-                pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 0, blow_out = False)
+                pickup_height = schedule['height'][k], rinse = False, avoid_droplet = False, wait_time = 0, blow_out = False)
+                k += 1
 
-                #m300.move_to(work_destinations[i].top(0))
-                #m300.air_gap(Water.air_gap_vol_bottom) #air gap
-                #m300.aspirate(air_gap_vol_bottom, work_destinations[i].top(10), rate = Water.flow_rate_aspirate) #air gap
+            start_incubation(i) # Elution incubation of this column starts now
             ctx.comment(' ')
             ctx.comment('Mixing sample with Water')
             #Mixing
@@ -1159,86 +1212,24 @@ def run(ctx: protocol_api.ProtocolContext):
             blow_out = False, mix_height = 0, offset = x_offset_dest)
             m300.move_to(work_destinations[i].top(0))
             m300.air_gap(Water.air_gap_vol_bottom) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-            tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 20 Transfer water
-        ########
-
-    ###############################################################################
-    # STEP 21 WAIT FOR 10'
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for ' + format(STEPS[STEP]['wait_time']) + ' seconds.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ####################################################################
-        # STEP 21* WAIT FOR 10'
-        ########
-
-    ###############################################################################
-    # STEP 22 INCUBATE WAIT WITH MAGNET ON
-    ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
-        # switch on magnet
-        magdeck.engage(mag_height)
-        ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for 5 minutes.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ####################################################################
-        # STEP 22* WAIT FOR 5'
-        ########
+            drop(m300)
 
     ###############################################################################
     # STEP 23 TRANSFER TO ELUTION PLATE
     ########
-    STEP += 1
-    if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(STEP)+': '+STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-        ctx.comment(' ')
+    def transfer_elution(step):
+        if set_temp_on == True: # The elution plate sits on the temperature module
+            wait_for_tempdeck()
         #max_volume_allowed = 150 # Tips allow up to 200uL, but we only allow max_volume_allowed
         elution_trips = math.ceil(Elution.reagent_volume / Elution.max_volume_allowed)
         elution_volume = Elution.reagent_volume / elution_trips
         elution_vol = []
         for i in range(elution_trips):
             elution_vol.append(elution_volume + Elution.disposal_volume)
-        #elution_vol =[50]
         x_offset_rs = 2
-        for i in range(num_cols):
+        for i in col_order:
             x_offset_source = find_side(i) * x_offset_rs
-            x_offset_dest   = (find_side(i) * x_offset_rs)
+            x_offset_dest   = find_side(i) * x_offset_rs
             if not m300.hw_pipette['has_tip']:
                 pick_up(m300)
             for transfer_vol in elution_vol:
@@ -1250,39 +1241,100 @@ def run(ctx: protocol_api.ProtocolContext):
                 move_vol_multi(m300, reagent = Elution, source = work_destinations[i],
                 dest = final_destinations[i], vol = transfer_vol, x_offset_source = x_offset_source, x_offset_dest = x_offset_dest,
                 pickup_height = pickup_height, rinse = False, avoid_droplet = False, wait_time = 2, blow_out = False)
+            drop(m300)
 
-                #m300.move_to(final_destinations[i].top(0))
-                #m300.air_gap(Elution.air_gap_vol_bottom) #air gap
-            if recycle_tip == True:
-                m300.return_tip()
-            else:
-                m300.drop_tip(home_after = False)
-                tip_track['counts'][m300] += 8
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
-        ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-        ###############################################################################
-        # STEP 23 TRANSFER TO ELUTION PLATE
-        ########
+    ###############################################################################
+    # Each STEP of the STEPS dictionary is executed by one of the functions above
+    step_functions = {
+        1: mix_beads,
+        2: transfer_lysis,
+        3: incubate_columns,
+        4: incubate_magnet_on,
+        5: lambda step: remove_supernatant(step, Lysis, Lysis.reagent_volume + sample_volume),
+        6: magnet_off,
+        7: lambda step: add_wash(step, VHB),
+        8: incubate_magnet_on,
+        9: lambda step: remove_supernatant(step, VHB, VHB.reagent_volume),
+        10: magnet_off,
+        11: lambda step: add_wash(step, SPR),
+        12: incubate_magnet_on,
+        13: lambda step: remove_supernatant(step, SPR, SPR.reagent_volume),
+        14: magnet_off,
+        15: lambda step: add_wash(step, SPR),
+        16: incubate_magnet_on,
+        17: lambda step: remove_supernatant(step, SPR, SPR.reagent_volume),
+        18: incubate_magnet_off,
+        19: magnet_off,
+        20: add_water,
+        21: incubate_columns,
+
+        22: incubate_magnet_on,
+        23: transfer_elution,
+        }
 
-    '''if not ctx.is_simulating():
-        with open(file_path,'w') as outfile:
-            json.dump(STEPS, outfile)'''
+    ###############################################################################
+    # Continuous run: the plates are processed back to back
+    ########
+    def swap_plate(plate):
+        '''
+        Prepares plate number plate (0 based) of a continuous run. In a single pause the
+        deepwell and elution plates are swapped, the reservoir columns are topped up to the
+        loading sheet volumes and the waste is emptied. Tips carry over: the tip plan is done
+        again for the tips left in the racks, unless they would run out before any incubation
+        of the plate: then the tipracks are replaced in the same pause
+        '''
+        nonlocal waste, tip_plan
+        magdeck.disengage()
+        tip_plan = plan_tips(tip_track['counts'][m300])
+        replace_tips = tip_plan['unplanned'] > 0
+        ctx.pause('Plate ' + str(plate + 1) + ' of ' + str(queued_plates) + ': place the next deepwell plate on the ' +
+                  'magnetic module and an empty elution plate on the temperature module, top up the reservoirs ' +
+                  'to the loading sheet volumes' + (', replace the tipracks' if replace_tips else '') +
+                  ' and empty the waste reservoir' + ('s' if second_waste == True else '') + ' before resuming.')
+        if replace_tips:
+            m300.reset_tipracks()
+            tip_track['used'][m300] += tip_track['counts'][m300]
+            tip_track['counts'][m300] = 0
+            tip_plan = plan_tips(0)
+        for reagent in [Lysis, VHB, SPR, Water]:
+            reagent.col = 0
+            reagent.vol_well = reagent.vol_well_original
+            reagent.last_prewet = None
+        waste = waste_reservoir.wells()[0]
+
+    plate_times = []
+    try:
+        for plate in range(queued_plates):
+            journal['plate'] = plate + 1
+            if plate > 0:
+                swap_plate(plate)
+            start = time.monotonic()
+            run_steps(STEPS, step_functions)
+            plate_times.append(time.monotonic() - start)
+            if queued_plates > 1:
+                ctx.comment('Plate ' + str(plate + 1) + ' of ' + str(queued_plates) + ' took ' +
+                            str(timedelta(seconds = plate_times[-1])))
+
+        '''if not ctx.is_simulating():
+            with open(file_path,'w') as outfile:
+                json.dump(STEPS, outfile)'''
 
-    ctx.comment(' ')
-    ctx.comment('###############################################')
-    ctx.comment('Homing robot')
-    ctx.comment('###############################################')
-    ctx.comment(' ')
-    ctx.home()
+        ctx.comment(' ')
+        ctx.comment('###############################################')
+        ctx.comment('Homing robot')
+        ctx.comment('###############################################')
+        ctx.comment(' ')
+        ctx.home()
 
-    # Disengage magnet
-    magdeck.disengage()
+        # Disengage magnet
+        magdeck.disengage()
+    except Exception as e:
+        journal_event('run_error', error = type(e).__name__ + ': ' + str(e))
+        raise
+    finally:
+        journal_close()
 ###############################################################################
     # Light flash end of program
-    import os
     #os.system('mpg123 /etc/audio/speaker-test.mp3')
     for i in range(3):
         gpio.set_rail_lights(False)
@@ -1293,6 +1345,9 @@ def run(ctx: protocol_api.ProtocolContext):
         time.sleep(0.3)
     gpio.set_button_light(0,1,0)
     ctx.comment('Finished! \nMove deepwell plate (slot 5) to Station C for MMIX addition and PCR preparation.')
-    ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
-    ctx.comment('Used racks in total: '+str(tip_track['counts'][m300]/96))
+    ctx.comment('Used tips in total: '+str(tip_track['used'][m300] + tip_track['counts'][m300]))
+    ctx.comment('Used racks in total: '+str((tip_track['used'][m300] + tip_track['counts'][m300])/96))
     ctx.comment('Available tips: '+str(tip_track['maxes'][m300]))
+    for plate, plate_time in enumerate(plate_times):
+        if queued_plates > 1:
+            ctx.comment('Plate ' + str(plate + 1) + ': ' + str(timedelta(seconds = plate_time)))
@@ -3,6 +3,7 @@ from opentrons.types import Point
 from opentrons import protocol_api
 import time
 import os
+import numpy as np
 from timeit import default_timer as timer
 import json
 from datetime import datetime
@@ -28,6 +29,13 @@ NUM_SAMPLES = 47
 air_gap_vol_ci = 2
 air_gap_vol_sample = 5
 run_id = '$run_id'
+pool_size = 1 # Source tubes pooled into each deepwell: 1 for no pooling, 2 to 8 for pooled screening
+positive_pools = [] # Re-test run: pools of a pooling run to break back into single tubes, i.e. [3, 17]
+retest_run_id = '' # Re-test run: run_id of the pooling run whose StationA_pool_map.csv is read
+retest_plate = 1 # Re-test run: plate of the positive pools (1 based) if the pooling run had queued_plates > 1
+streaming = False # Load one 24 tube rack at a time in slot 4, pausing for the operator to swap it
+queued_plates = 1 # Deepwell plates filled back to back, NUM_SAMPLES tubes each, with a pause to swap them
+priority_tubes = [] # STAT lane: tubes (1 based) whose wells are packed first, in column 1, i.e. [5, 12]
 
 TNA_VOLUME = 240 # TNA Volume to be added
 ISO_VOLUME = 280 # Isoproponaol volume to be added
@@ -69,6 +77,176 @@ def run(ctx: protocol_api.ProtocolContext):
             os.mkdir(folder_path)
         file_path = folder_path + '/StationA_time_log.txt'
         file_path2 = folder_path + '/StationA_tips_log.txt'
+        if positive_pools:
+            file_path3 = folder_path + '/StationA_retest_map.csv'
+        else:
+            file_path3 = folder_path + '/StationA_pool_map.csv'
+
+    ##########
+    # Event journal: one json line per command and per step boundary, timed with the monotonic
+    # clock from the start of the run. It is only written on the robot.
+    journal = {'file': None, 'buffer': [], 'start': time.monotonic(), 'plate': 1, 'step': 0, 'running': []}
+
+    def journal_event(event, t = None, **data):
+        record = {'t': round((time.monotonic() if t is None else t) - journal['start'], 3), 'event': event,
+                  'plate': journal['plate'], 'step': journal['step']}
+        record.update({key: value for key, value in data.items() if value is not None})
+        journal['buffer'].append(json.dumps(record, default = str))
+
+    def journal_flush():
+        '''
+        Writes the buffered records at once. It is done at step boundaries and pauses, while the
+        robot stands still, so that writing to the SD card does not stall a movement. Only whole
+        lines are written and synced, so a run that aborts leaves a valid journal up to its last flush
+        '''
+        if journal['file'] is not None and journal['buffer']:
+            journal['file'].write('\n'.join(journal['buffer']) + '\n')
+            journal['file'].flush()
+            os.fsync(journal['file'].fileno())
+        journal['buffer'] = []
+
+    def journal_command(message):
+        '''
+        Broker callback of every command: the record is buffered when the command ends, with the
+        time it started, its duration and the well and volume it used
+        '''
+        if message['$'] == 'before':
+            journal['running'].append(time.monotonic())
+            if message['name'] == 'command.PAUSE':
+                journal_flush()
+            return
+        start = journal['running'].pop() if journal['running'] else time.monotonic()
+        payload = message['payload']
+        location = payload.get('location')
+        if location is not None and hasattr(location, 'labware'):
+            location = location.labware # A Location is a point and the well it refers to
+        journal_event('command', t = start, name = message['name'].split('.')[-1].lower(),
+                      seconds = round(time.monotonic() - start, 3), well = str(location) if location is not None else None,
+                      volume = payload.get('volume'), text = payload.get('text'))
+
+    def journal_step(step, description):
+        '''
+        Step boundary: the records so far are written and the next ones belong to step
+        '''
+        journal_flush()
+        journal['step'] = step
+        journal_event('step_start', description = description)
+
+    def journal_step_end(**stats):
+        journal_event('step_end', **stats)
+        journal_flush()
+        journal['step'] = 0 # Pauses and swaps between steps
+
+    def journal_close():
+        '''
+        Ends the journal with the run_end record, closes it and stops listening to the commands.
+        Called from a finally clause, so the journal of a run that raises is also complete
+        '''
+        journal_event('run_end', seconds = round(time.monotonic() - journal['start'], 3))
+        journal_flush()
+        if journal['file'] is not None:
+            journal_unsubscribe()
+            journal['file'].close()
+            journal['file'] = None
+
+    journal_unsubscribe = None
+    if not ctx.is_simulating():
+        journal['file'] = open(folder_path + '/StationA_journal_' + datetime.now().strftime('%Y%m%d_%H%M%S') + '.jsonl', 'w')
+        journal_unsubscribe = ctx.broker.subscribe('command', journal_command) # Every command of the run
+    journal_event('run_start', protocol = metadata['protocolName'], NUM_SAMPLES = NUM_SAMPLES,
+                  date = datetime.now().isoformat())
+
+    ####################################
+    # Source tubes and the deepwell they go to
+    ####################################
+    rack_slots = ['4', '1', '6', '3']
+
+    def rack_index(position):
+        '''
+        Order of a position in a 24 tube rack, which is filled by columns (A1, B1, C1, D1, A2...)
+        '''
+        return (int(position[1:]) - 1) * 4 + 'ABCD'.index(position[0])
+
+    def pool_map(num_tubes, size):
+        '''
+        Tubes of a pooling run: consecutive tubes share a pool and fill the racks in order.
+        Once the racks are full the next tubes go to the same positions in a new rack load.
+        When streaming every rack load is a single rack in slot 4.
+        '''
+        capacity = 24 if streaming == True else min(num_tubes, 96)
+        tubes = []
+        for i in range(num_tubes):
+            j = i % capacity
+            tubes.append({'pool': i // size + 1, 'tube': i + 1, 'rack_load': i // capacity + 1,
+                          'slot': rack_slots[j // 24], 'position': 'ABCD'[j % 4] + str(j % 24 // 4 + 1)})
+        return tubes
+
+    def retest_map():
+        '''
+        Tubes of the positive pools of run retest_run_id, ordered to load and pick them up
+        rack load by rack load and rack by rack. A run of queued plates wrote a pool map per
+        plate, the one of plate retest_plate is read.
+        '''
+        map_path = '/var/lib/jupyter/notebooks/' + retest_run_id + '/StationA_pool_map.csv'
+        if retest_plate > 1 or not os.path.isfile(map_path):
+            map_path = map_path.replace('.csv', '_plate' + str(retest_plate) + '.csv')
+        if os.path.isfile(map_path):
+            with open(map_path, newline = '') as f:
+                tubes = [{'pool': int(row['pool']), 'tube': int(row['tube']),
+                          'rack_load': int(row['rack_load']), 'slot': row['slot'],
+                          'position': row['position']} for row in csv.DictReader(f)]
+            ctx.comment('Positive pools of ' + os.path.basename(map_path) + ' of run ' + retest_run_id)
+        elif ctx.is_simulating():
+            ctx.comment('No pool map found for run ' + retest_run_id + ', simulating with ' +
+                        str(NUM_SAMPLES) + ' tubes in pools of ' + str(pool_size))
+            tubes = pool_map(NUM_SAMPLES, pool_size)
+        else:
+            raise Exception('Pool map ' + map_path + ' not found')
+        missing = [p for p in positive_pools if p not in [t['pool'] for t in tubes]]
+        if missing:
+            raise Exception('Positive pools ' + str(missing) + ' are not in the pool map ' + map_path)
+        tubes = [t for t in tubes if t['pool'] in positive_pools]
+        return sorted(tubes, key = lambda t: (t['rack_load'], rack_slots.index(t['slot']),
+                                              rack_index(t['position'])))
+
+    if positive_pools:
+        if not isinstance(retest_plate, int) or retest_plate < 1:
+            raise Exception('retest_plate must be the number of a plate of the pooling run (1 based), not ' +
+                            str(retest_plate))
+        # Every tube of a positive pool goes to its own well, filling whole columns in order
+        tubes = retest_map()
+        pools = [[i] for i in range(len(tubes))]
+        ctx.comment('Re-testing ' + str(len(tubes)) + ' tubes of ' + str(len(positive_pools)) +
+                    ' positive pools in ' + str(math.ceil(len(tubes) / 8)) + ' columns')
+        ctx.comment('Set NUM_SAMPLES = ' + str(len(tubes)) + ' in Stations B and C')
+    else:
+        if not 1 <= pool_size <= 8:
+            raise Exception('pool_size must be between 1 and 8, not ' + str(pool_size))
+        # NUM_SAMPLES counts source tubes, each deepwell receives up to pool_size of them
+        tubes = pool_map(NUM_SAMPLES, pool_size)
+        pools = [list(range(NUM_SAMPLES))[w * pool_size:(w + 1) * pool_size]
+                 for w in range(math.ceil(NUM_SAMPLES / pool_size))]
+        if pool_size > 1:
+            ctx.comment('Pooling ' + str(NUM_SAMPLES) + ' tubes into ' + str(len(pools)) +
+                        ' wells (' + str(pool_size) + ' tubes per well)')
+            ctx.comment('Set NUM_SAMPLES = ' + str(len(pools)) + ' in Stations B and C')
+    if len(pools) > 96:
+        raise Exception(str(len(tubes)) + ' tubes need ' + str(len(pools)) +
+                        ' deepwells, only 96 fit in the plate')
+    if positive_pools and queued_plates > 1:
+        raise Exception('A re-test run fills a single plate, set queued_plates = 1')
+
+    # STAT lane: the pools with a priority tube take the first wells of the plate, the
+    # tubes are still picked up in rack order
+    missing = [t for t in priority_tubes if t not in [tube['tube'] for tube in tubes]]
+    if missing:
+        raise Exception('Priority tubes ' + str(missing) + ' are not in this run')
+    stat_pools = [p for p, pool in enumerate(pools) if any(tubes[i]['tube'] in priority_tubes for i in pool)]
+    well_order = stat_pools + [p for p in range(len(pools)) if p not in stat_pools]
+    if stat_pools:
+        stat_cols = list(range(1, math.ceil(len(stat_pools) / 8) + 1))
+        ctx.comment('STAT lane: ' + str(len(stat_pools)) + ' priority wells in column(s) ' +
+                    str(stat_cols)[1:-1] + ', set priority_columns = ' + str(stat_cols) + ' in Stations B and C')
 
     # Define Reagents as objects with their properties
     class Reagent:
@@ -213,32 +391,160 @@ def run(ctx: protocol_api.ProtocolContext):
                 s = s + source[rack_number].wells()
         return s
 
+    def assign(cost):
+        '''
+        Minimum cost assignment of each row to a different column (Hungarian algorithm).
+        cost: array of rows x columns, with no more rows than columns.
+        Returns the column assigned to each row.
+        '''
+        n, m = cost.shape
+        u = np.zeros(n + 1)
+        v = np.zeros(m + 1)
+        p = np.zeros(m + 1, dtype = int)  # row (1-based) matched to each column, 0 if free
+        way = np.zeros(m + 1, dtype = int)
+        for i in range(1, n + 1):
+            p[0] = i
+            j0 = 0
+            minv = np.full(m + 1, np.inf)
+            used = np.zeros(m + 1, dtype = bool)
+            while p[j0] != 0:
+                used[j0] = True
+                i0 = p[j0]
+                reduced = cost[i0 - 1] - u[i0] - v[1:]
+                better = ~used[1:] & (reduced < minv[1:])
+                minv[1:][better] = reduced[better]
+                way[1:][better] = j0
+                j1 = np.argmin(np.where(used[1:], np.inf, minv[1:])) + 1
+                delta = minv[j1]
+                u[p[used]] += delta
+                v[used] -= delta
+                minv[~used] -= delta
+                j0 = j1
+            while j0:
+                j1 = way[j0]
+                p[j0] = p[j1]
+                j0 = j1
+        columns = np.zeros(n, dtype = int)
+        columns[p[1:][p[1:] > 0] - 1] = np.nonzero(p[1:])[0]
+        return columns
+
+    def positions(wells):
+        '''
+        Deck x, y coordinates of the wells
+        '''
+        return np.array([[w.top().point.x, w.top().point.y] for w in wells])
+
+    def plan_tips(pip, targets, starts = None, new_racks = None):
+        '''
+        Choose the tip for each of the next pickups of pip.
+        targets: first location each new tip goes to, in pickup order.
+        starts: where the head comes from before each pickup, the trash by default.
+        new_racks: pickups that start with new tipracks, every full set of tipracks by default.
+        Every tip cycle starts back from the trash, so the order of the tubes does not change
+        the travel, only which tip serves each tube does. The pickups sharing a tiprack load
+        get the tips that make start -> tip -> target shortest.
+        '''
+        nonlocal tip_track
+        if len(targets) == 0:
+            return
+        if starts is None:
+            starts = ctx.fixed_trash.wells()[:1] * len(targets)
+        tips = [w for rack in pip.tip_racks for w in rack.wells()]
+        # Tips left in the loaded tipracks by the previous plates of the run
+        free = [w for w in tips if w not in tip_track['taken'][pip]]
+        if new_racks is None:
+            new_racks = [0] + list(range(len(free), len(targets), len(tips)))
+        plan = []
+        distance = {'planned': 0, 'rack order': 0}
+        for b, e in zip(new_racks, list(new_racks[1:]) + [len(targets)]):
+            if b == e:
+                continue
+            candidates = free if b == 0 else tips
+            tip_xy = positions(candidates)
+            block = positions(targets[b:e])
+            origin = positions(starts[b:e])
+            cost = (np.linalg.norm(origin[:, None, :] - tip_xy[None, :, :], axis = 2) +
+                    np.linalg.norm(block[:, None, :] - tip_xy[None, :, :], axis = 2))
+            columns = assign(cost)
+            plan += [candidates[j] for j in columns]
+            distance['planned'] += cost[np.arange(len(block)), columns].sum()
+            distance['rack order'] += cost[np.arange(len(block)), np.arange(len(block))].sum()
+        tip_track['plan'][pip] = plan
+        ctx.comment('Tip plan for ' + str(pip.max_volume) + 'µl pickups: ' +
+                    str(round(distance['planned'] / 1000, 1)) + ' m to and from the tips instead of ' +
+                    str(round(distance['rack order'] / 1000, 1)) + ' m in rack order')
+
+    def load_rack(i):
+        '''
+        Pauses for the operator to load the rack load of tube i. When streaming, the p1000
+        tipracks are replaced in the same pause if they would run out during that rack.
+        '''
+        nonlocal tip_track
+        load = [t['tube'] for t in tubes if t['rack_load'] == tubes[i]['rack_load']]
+        message = ('Load tubes ' + str(min(load)) + ' to ' + str(max(load)) +
+                   ' (rack load ' + str(tubes[i]['rack_load']) + ') in the source racks')
+        if i in tiprack_swaps:
+            swap_tipracks(p1000, message + '. ')
+        else:
+            ctx.pause(message + ' before resuming.')
+
+    def swap_plate(plate, tips_needed):
+        '''
+        Pauses for the operator to place the deepwell plate number plate (0 based) of a run of
+        queued plates and load its first rack load of tubes. In the same pause the tipracks are
+        replaced if the tips left would run out during the plate, and so is the reagent tube if
+        it would run dry. Otherwise the tips and the reagent left carry over to the new plate.
+        tips_needed: pickups of each pipette in the plate
+        '''
+        load = [t['tube'] for t in tubes if t['rack_load'] == 1]
+        message = ('Plate ' + str(plate + 1) + ' of ' + str(queued_plates) + ': move the filled deepwell plate ' +
+                   'to Station B, place an empty one in slot 5 and load tubes ' + str(min(load)) + ' to ' +
+                   str(max(load)) + ' in the source racks')
+        if STEPS[1]['Execute'] == True and BUFFER.vol_well < volume_control * len(destinations):
+            message += ', replace the lysis buffer falcon'
+            BUFFER.vol_well = BUFFER.vol_well_original
+        replace = [pip for pip in tips_needed
+                   if tip_track['counts'][pip] + tips_needed[pip] > tip_track['maxes'][pip]]
+        for pip in replace:
+            message += ', replace the ' + str(pip.max_volume) + 'µl tipracks'
+            reset_tips(pip)
+        ctx.pause(message + ' before resuming.')
+
     ##########
     # pick up tip and if there is none left, prompt user for a new rack
     def pick_up(pip):
         nonlocal tip_track
         if not ctx.is_simulating():
             if tip_track['counts'][pip] == tip_track['maxes'][pip]:
-                ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-                resuming.')
-                pip.reset_tipracks()
-                tip_track['counts'][pip] = 0
-        pip.pick_up_tip()
+                swap_tipracks(pip)
+        if tip_track['plan'][pip]:
+            tip = tip_track['plan'][pip].pop(0)
+            tip_track['taken'][pip].append(tip)
+            pip.pick_up_tip(tip)
+        else:
+            pip.pick_up_tip()
+
+    def swap_tipracks(pip, message = ''):
+        ctx.pause(message + 'Replace ' + str(pip.max_volume) + 'µl tipracks before resuming.')
+        reset_tips(pip)
+
+    def reset_tips(pip):
+        nonlocal tip_track
+        pip.reset_tipracks()
+        tip_track['used'][pip] += tip_track['counts'][pip]
+        tip_track['counts'][pip] = 0
+        tip_track['taken'][pip] = []
 
     ####################################
     # load labware and modules
     ####################################
 
     # Load Sample racks
-    if NUM_SAMPLES < 96:
-        rack_num = math.ceil(NUM_SAMPLES / 24)
-        ctx.comment('Used source racks are ' + str(rack_num))
-        samples_last_rack = NUM_SAMPLES - rack_num * 24
-    else:
-        rack_num = 4
+    rack_num = max([rack_slots.index(t['slot']) for t in tubes]) + 1
+    ctx.comment('Used source racks are ' + str(rack_num))
     source_racks = [ctx.load_labware(
         'opentrons_24_tuberack_generic_2ml_screwcap', slot,
-        'source tuberack with screwcap' + str(i + 1)) for i, slot in enumerate(['4', '1', '6', '3'][:rack_num])
+        'source tuberack with screwcap' + str(i + 1)) for i, slot in enumerate(rack_slots[:rack_num])
     ]
 
     ##################################
@@ -274,9 +580,8 @@ def run(ctx: protocol_api.ProtocolContext):
     BUFFER.reagent_reservoir = reagents.wells()[0]
 
     # setup samples and destinations
-    sample_sources_full = generate_source_table(source_racks)
-    sample_sources = sample_sources_full[:NUM_SAMPLES]
-    destinations = dest_plate.wells()[:NUM_SAMPLES]
+    sample_sources = [source_racks[rack_slots.index(t['slot'])][t['position']] for t in tubes]
+    destinations = [dest_plate.wells()[well_order.index(p)] for p in range(len(pools))]
 
     p20 = ctx.load_instrument(
         'p20_single_gen2', mount='right', tip_racks=tips20)
@@ -285,92 +590,163 @@ def run(ctx: protocol_api.ProtocolContext):
     # used tip counter and set maximum tips available
     tip_track = {
         'counts': {p20: 0, p1000: 0},
-        'maxes': {p20: len(tips20)*96, p1000: len(tips1000)*96}
+        'maxes': {p20: len(tips20)*96, p1000: len(tips1000)*96},
+        'plan': {p20: [], p1000: []},
+        'used': {p20: 0, p1000: 0}, # Tips of the tipracks already replaced
+        'taken': {p20: [], p1000: []} # Planned tips picked from the loaded tipracks
     }
 
-    ############################################################################
-    # STEP 1: Add TNA
-    ############################################################################
-    STEP += 1
-    if STEPS[STEP]['Execute'] == True:
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-
-        # Transfer parameters
-        start = datetime.now()
-        if not p1000.hw_pipette['has_tip']:
-            pick_up(p1000)
-        for d in destinations:
-            # Calculate pickup_height based on remaining volume and shape of container
-            [pickup_height, change_col] = calc_height(BUFFER, falcon_cross_section_area, volume_control)
-            move_vol_multichannel(p1000, reagent = BUFFER, source = BUFFER.reagent_reservoir,
-            dest = d, vol=volume_control, air_gap_vol = air_gap_vol_ci,
-            x_offset = x_offset, pickup_height = pickup_height, rinse = BUFFER.rinse,
-            disp_height = height_control, blow_out = True, touch_tip = True)
-
-            # Mix the sample AFTER dispensing using 15µl of volume
-            #custom_mix(p20, reagent = Control_I, location = d, vol = 15, rounds = 4, blow_out = True, mix_height = 15)
-
-            #Do not drop tip as it is not contaminated
-            #p1000.drop_tip()
-            #tip_track['counts'][p20]+=1
-
-        #Time statistics
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] +
-        ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
-
-    ############################################################################
-    # STEP 2: Add Samples
-    ############################################################################
-    STEP += 1
-    if STEPS[STEP]['Execute'] == True:
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
-        ctx.comment('###############################################')
-
-        # Transfer parameters
-        start = datetime.now()
-        for s, d in zip(sample_sources, destinations):
-            if not p1000.hw_pipette['has_tip']:
-                pick_up(p1000)
-
-            # Mix the sample BEFORE dispensing
-            #custom_mix(p1000, reagent = Samples, location = s, vol = volume_sample, rounds = 2, blow_out = True, mix_height = 15)
-            move_vol_multichannel(p1000, reagent=Samples, source=s, dest=d,
-            vol=volume_sample, air_gap_vol=air_gap_vol_sample, x_offset=x_offset,
-                               pickup_height=1, rinse=Samples.rinse, disp_height=-10,
-                               blow_out=True, touch_tip=True)
-            # Mix the sample AFTER dispensing using 15µl of volume
-            custom_mix(p1000, reagent = Samples, location = d, vol = 800, rounds = 2, blow_out = False, mix_height = 10)
-
-            p1000.drop_tip()
-            tip_track['counts'][p1000] += 1
-
-        # Time statistics
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] +
-                    ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
 
+    steps_log = [] # Step times of each plate
+    try:
+        for plate in range(queued_plates):
+            STEP = 0
+            plate_start = datetime.now()
+            journal['plate'] = plate + 1
+
+            # Tips for the plate, the lysis buffer tip is reused for the first sample
+            p1000_targets = []
+            if STEPS[1]['Execute'] == True:
+                p1000_targets.append(BUFFER.reagent_reservoir)
+            if STEPS[2]['Execute'] == True:
+                p1000_targets += sample_sources[len(p1000_targets):]
+            if plate > 0:
+                swap_plate(plate, {p1000: len(p1000_targets)})
+
+            # When streaming, the p1000 tipracks are only replaced while swapping sample racks,
+            # before the first rack whose tubes would not fit in the tips left
+            tiprack_swaps = []
+            if streaming == True and STEPS[2]['Execute'] == True:
+                left = tip_track['maxes'][p1000] - tip_track['counts'][p1000]
+                for i in range(len(tubes)):
+                    if i > 0 and tubes[i]['rack_load'] != tubes[i - 1]['rack_load']:
+                        rack_tubes = len([t for t in tubes if t['rack_load'] == tubes[i]['rack_load']])
+                        if rack_tubes > left:
+                            tiprack_swaps.append(i)
+                            left = tip_track['maxes'][p1000]
+                    left -= 1
+
+            plan_tips(p1000, p1000_targets, new_racks = [0] + tiprack_swaps if tiprack_swaps else None)
+
+            # Pool (or re-test) map with the tip of each tube, written before pipetting so it is
+            # available even if the run aborts. The tube -> well mapping is not changed by the tip plan.
+            if not ctx.is_simulating():
+                tube_tips = [tip.display_name.split(' ')[0] for tip in tip_track['plan'][p1000]]
+                map_path = file_path3 if queued_plates == 1 else file_path3.replace('.csv', '_plate' + str(plate + 1) + '.csv')
+                with open(map_path, 'w', newline = '') as f3:
+                    writer = csv.writer(f3)
+                    writer.writerow(['pool', 'well', 'tube', 'rack_load', 'slot', 'position', 'tip'])
+                    for d, pool in zip(destinations, pools):
+                        for i in pool:
+                            t = tubes[i]
+                            writer.writerow([t['pool'], d.display_name.split(' ')[0], t['tube'],
+                                             t['rack_load'], t['slot'], t['position'],
+                                             tube_tips[i] if i < len(tube_tips) else ''])
+
+            ############################################################################
+            # STEP 1: Add TNA
+            ############################################################################
+            STEP += 1
+            if STEPS[STEP]['Execute'] == True:
+                ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
+                ctx.comment('###############################################')
+                journal_step(STEP, STEPS[STEP]['description'])
+
+                # Transfer parameters
+                start = datetime.now()
+                if not p1000.hw_pipette['has_tip']:
+                    pick_up(p1000)
+                for d in destinations:
+                    # Calculate pickup_height based on remaining volume and shape of container
+                    [pickup_height, change_col] = calc_height(BUFFER, falcon_cross_section_area, volume_control)
+                    move_vol_multichannel(p1000, reagent = BUFFER, source = BUFFER.reagent_reservoir,
+                    dest = d, vol=volume_control, air_gap_vol = air_gap_vol_ci,
+                    x_offset = x_offset, pickup_height = pickup_height, rinse = BUFFER.rinse,
+                    disp_height = height_control, blow_out = True, touch_tip = True)
+
+                    # Mix the sample AFTER dispensing using 15µl of volume
+                    #custom_mix(p20, reagent = Control_I, location = d, vol = 15, rounds = 4, blow_out = True, mix_height = 15)
+
+                    #Do not drop tip as it is not contaminated
+                    #p1000.drop_tip()
+                    #tip_track['counts'][p20]+=1
+
+                #Time statistics
+                end = datetime.now()
+                time_taken = (end - start)
+                ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] +
+                ' took ' + str(time_taken))
+                STEPS[STEP]['Time:'] = str(time_taken)
+                journal_step_end(seconds = round(time_taken.total_seconds(), 3))
+
+            ############################################################################
+            # STEP 2: Add Samples
+            ############################################################################
+            STEP += 1
+            if STEPS[STEP]['Execute'] == True:
+                ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'])
+                ctx.comment('###############################################')
+                journal_step(STEP, STEPS[STEP]['description'])
+
+                # Transfer parameters
+                start = datetime.now()
+                for pool, d in zip(pools, destinations):
+                    # Each tube of the pool gets its share of the sample volume and its own tip
+                    for i in pool:
+                        if i > 0 and tubes[i]['rack_load'] != tubes[i - 1]['rack_load']:
+                            load_rack(i)
+                        s = sample_sources[i]
+                        if not p1000.hw_pipette['has_tip']:
+                            pick_up(p1000)
+
+                        # Mix the sample BEFORE dispensing
+                        #custom_mix(p1000, reagent = Samples, location = s, vol = volume_sample, rounds = 2, blow_out = True, mix_height = 15)
+                        move_vol_multichannel(p1000, reagent=Samples, source=s, dest=d,
+                        vol=volume_sample / len(pool), air_gap_vol=air_gap_vol_sample, x_offset=x_offset,
+                                           pickup_height=1, rinse=Samples.rinse, disp_height=-10,
+                                           blow_out=True, touch_tip=True)
+                        # Mix the sample AFTER dispensing the last tube of the pool
+                        if i == pool[-1]:
+                            custom_mix(p1000, reagent = Samples, location = d, vol = 800, rounds = 2, blow_out = False, mix_height = 10,
+                                       x_offset = x_offset)
+
+                        p1000.drop_tip()
+                        tip_track['counts'][p1000] += 1
+
+                # Time statistics
+                end = datetime.now()
+                time_taken = (end - start)
+                ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] +
+                            ' took ' + str(time_taken))
+                STEPS[STEP]['Time:'] = str(time_taken)
+                journal_step_end(seconds = round(time_taken.total_seconds(), 3))
+
+            steps_log.append((plate, {key: dict(STEPS[key]) for key in STEPS}))
+            if queued_plates > 1:
+                ctx.comment('Plate ' + str(plate + 1) + ' of ' + str(queued_plates) + ' took ' +
+                            str(datetime.now() - plate_start))
+    except Exception as e:
+        journal_event('run_error', error = type(e).__name__ + ': ' + str(e))
+        raise
+    finally:
+        journal_close()
 
     # Export the time log to a tsv file
     if not ctx.is_simulating():
         with open(file_path, 'w') as f:
             f.write('STEP\texecution\tdescription\twait_time\texecution_time\n')
-            for key in STEPS.keys():
-                row = str(key)
-                for key2 in STEPS[key].keys():
-                    row += '\t' + format(STEPS[key][key2])
-                f.write(row + '\n')
+            for plate, steps in steps_log:
+                for key in steps.keys():
+                    row = str(key) if queued_plates == 1 else str(plate + 1) + '.' + str(key)
+                    for key2 in steps[key].keys():
+                        row += '\t' + format(steps[key][key2])
+                    f.write(row + '\n')
         f.close()
         with open(file_path2, 'w') as f2:
             f2.write('pipette\ttip_count\n')
             for key in tip_track['counts'].keys():
                 row=str(key)
-                f.write(str(key)+'\t'+format(tip_track['counts'][key]))
+                f2.write(str(key)+'\t'+format(tip_track['used'][key] + tip_track['counts'][key])+'\n')
         f2.close()
 
     ############################################################################
@@ -388,7 +764,7 @@ def run(ctx: protocol_api.ProtocolContext):
     gpio.set_button_light(0, 1, 0)
     ctx.comment(
         'Finished! \nMove deepwell plate (slot 5) to Station B for extraction protocol')
-    ctx.comment('Used p1000 tips in total: ' + str(tip_track['counts'][p1000]))
-    ctx.comment('Used p1000 racks in total: ' + str(tip_track['counts'][p1000] / 96))
-    ctx.comment('Used p20 tips in total: ' + str(tip_track['counts'][p20]))
-    ctx.comment('Used p20 racks in total: ' + str(tip_track['counts'][p20] / 96))
+    ctx.comment('Used p1000 tips in total: ' + str(tip_track['used'][p1000] + tip_track['counts'][p1000]))
+    ctx.comment('Used p1000 racks in total: ' + str((tip_track['used'][p1000] + tip_track['counts'][p1000]) / 96))
+    ctx.comment('Used p20 tips in total: ' + str(tip_track['used'][p20] + tip_track['counts'][p20]))
+    ctx.comment('Used p20 racks in total: ' + str((tip_track['used'][p20] + tip_track['counts'][p20]) / 96))
@@ -0,0 +1,3 @@
+'''
+Offline tools to run and analyse the station protocols without a robot or the opentrons package
+'''
@@ -0,0 +1,142 @@
+'''
+Benchmark matrix of the station protocols.
+
+Runs every kit x station x NUM_SAMPLES combination offline (see tools/recorder.py) over a pool of
+processes and writes one row per configuration: predicted duration (tools/estimator.py), tips and
+tipracks, pauses, reagent reservoir columns, waste volume and number of commands. The table is
+saved as csv or json, by the extension of the output file, to compare it across code changes.
+
+    python -m tools.benchmark --out benchmark.csv
+    python -m tools.benchmark --kits MAGMAX,OMEGA --stations B --samples 8-96 --out b.json tip_parking=True
+'''
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from tools import estimator, recorder
+
+COLUMNS = ['kit', 'station', 'NUM_SAMPLES', 'duration_s', 'duration', 'tips', 'tip_racks', 'pauses',
+           'reservoir_columns', 'waste_ml', 'commands', 'error']
+
+
+def measure(ctx, coefficients = None):
+    '''
+    Benchmark figures of a recorded run
+    '''
+    log = ctx.log
+    op = log.column('op')
+    well = log.column('well')
+    value = log.column('value')
+    pipette = log.column('pipette')
+    # Tips: a multichannel takes a whole column of tips at each pickup. Picking up again the
+    # tips that were dropped back into a tiprack well (tip parking, wash tips kept in the
+    # racks) does not take new tips
+    channels = np.array([recorder.PIPETTES[name][1] for name in log.pipettes])
+    returned = set()
+    new_tips = np.zeros(len(log), dtype = bool)
+    for i in np.nonzero((op == recorder.OP_CODE['pick_up']) | (op == recorder.OP_CODE['drop']))[0]:
+        if op[i] == recorder.OP_CODE['drop']:
+            returned.add(well[i])
+        elif well[i] in returned:
+            returned.discard(well[i])
+        else:
+            new_tips[i] = True
+    tips = {name: int(new_tips[pipette == i].sum()) * channels[i] for i, name in enumerate(log.pipettes)}
+    aspirated = set(well[op == recorder.OP_CODE['aspirate']].tolist())
+    reservoir_columns = len([w for w in aspirated if 'reservoir' in log.well_labware[w]])
+    # Waste: liquid dispensed in wells that are never aspirated from and are not sample plate wells,
+    # by every channel of the pipette
+    dispense = (op == recorder.OP_CODE['dispense']) & (well >= 0)
+    waste = [i for i in np.nonzero(dispense)[0]
+             if well[i] not in aspirated and log.well_columns[well[i]] < 0]
+    duration = estimator.estimate(ctx, coefficients)['total']
+    return {
+        'duration_s': round(duration),
+        'duration': estimator.hms(duration),
+        'tips': int(sum(tips.values())),
+        'tip_racks': sum(math.ceil(n / 96) for n in tips.values()),
+        'pauses': len(ctx.pauses),
+        'reservoir_columns': reservoir_columns,
+        'waste_ml': round(float((value[waste] * channels[pipette[waste]]).sum()) / 1000, 1),
+        'commands': len(log),
+    }
+
+
+def run_configuration(configuration):
+    '''
+    Benchmark row of a (protocol path, NUM_SAMPLES, variables, coefficients) configuration,
+    with the error instead of the figures if the protocol fails
+    '''
+    path, samples, variables, coefficients = configuration
+    row = {'kit': os.path.basename(os.path.dirname(path)),
+           'station': os.path.splitext(os.path.basename(path))[0].split('_')[-1],
+           'NUM_SAMPLES': samples}
+    try:
+        ctx = recorder.simulate(path, **dict(variables, NUM_SAMPLES = samples))
+        row.update(measure(ctx, coefficients))
+        row['error'] = ''
+    except Exception as e:
+        row['error'] = type(e).__name__ + ': ' + str(e)
+    return row
+
+
+def benchmark(paths, samples, variables = None, coefficients = None, jobs = None):
+    '''
+    Rows of every protocol in paths with every NUM_SAMPLES in samples, simulated in parallel
+    '''
+    configurations = [(path, n, variables or {}, coefficients) for path in paths for n in samples]
+    with ProcessPoolExecutor(max_workers = jobs) as pool:
+        return list(pool.map(run_configuration, configurations, chunksize = 4))
+
+
+def save(rows, path):
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(rows, f, indent = 1)
+    else:
+        with open(path, 'w', newline = '') as f:
+            writer = csv.DictWriter(f, fieldnames = COLUMNS, restval = '')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark every kit, station and NUM_SAMPLES offline')
+    parser.add_argument('variables', nargs = '*', help = 'NAME=value variables set in every protocol')
+    parser.add_argument('--kits', help = 'comma separated kits, every kit by default')
+    parser.add_argument('--stations', default = 'A,B,C', help = 'comma separated stations, i.e. A,B')
+    parser.add_argument('--samples', default = '8-96/8', help = 'NUM_SAMPLES values, i.e. 8,48,96 or 1-96 or 8-96/8')
+    parser.add_argument('--coefficients', help = 'json file with fitted estimator coefficients')
+    parser.add_argument('--jobs', type = int, help = 'worker processes, one per CPU by default')
+    parser.add_argument('--out', default = 'benchmark.csv', help = 'csv or json file for the table')
+    options = parser.parse_args(argv)
+    spec, _, every = options.samples.partition('/')
+    samples = recorder.parse_samples(spec)[::int(every or 1)]
+    stations = options.stations.split(',')
+    kits = options.kits.split(',') if options.kits else None
+    paths = [p for p in recorder.protocols()
+             if os.path.splitext(p)[0][-1] in stations and (kits is None or os.path.basename(os.path.dirname(p)) in kits)]
+    coefficients = None
+    if options.coefficients:
+        with open(options.coefficients) as f:
+            coefficients = json.load(f)
+    start = time.perf_counter()
+    rows = benchmark(paths, samples, recorder.parse_variables(options.variables), coefficients, options.jobs)
+    save(rows, options.out)
+    failed = [r for r in rows if r['error']]
+    print(str(len(rows)) + ' configurations in ' + str(round(time.perf_counter() - start, 1)) + ' s, saved to ' +
+          options.out + (', ' + str(len(failed)) + ' failed' if failed else ''))
+    for r in failed:
+        print(r['kit'] + ' Station_' + r['station'] + ' NUM_SAMPLES=' + str(r['NUM_SAMPLES']) + ': ' + r['error'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
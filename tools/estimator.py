@@ -0,0 +1,276 @@
+'''
+Runtime estimator for the station protocols.
+
+Predicts the wall-clock time of a run from its recorded commands (see tools/recorder.py), per step
+and per sample column, with a linear gantry and plunger model:
+
+    seconds = xy travel / xy speed + z travel / z speed + moves * move overhead
+              + volume / (flow rate * rate) + delays + fixed time of each tip, blow out, touch tip,
+              magnet and home command
+
+The coefficients of the model can be fitted to the step times of real runs, read from the
+Station A and C time logs (StationA_time_log.txt, Station_C_qPCR_time_log.txt), from the event
+journals of any station (Station_B_journal_<date>_<time>.jsonl...) or from the
+'Step N: ... took H:MM:SS' comments of any run log.
+
+    python -m tools.estimator MAGMAX/Station_B.py NUM_SAMPLES=96
+    python -m tools.estimator fit --run "MAGMAX/Station_B.py run_log.txt NUM_SAMPLES=96" --out coefficients.json
+    python -m tools.estimator MAGMAX/Station_B.py NUM_SAMPLES=96 --coefficients coefficients.json
+'''
+import argparse
+import json
+import re
+import shlex
+import sys
+from datetime import timedelta
+
+import numpy as np
+
+from tools import recorder
+
+# Seconds per unit of each feature of a command
+COEFFICIENTS = {
+    'xy_mm': 1 / 400,  # Gantry at 400 mm/s
+    'z_mm': 1 / 125,  # Z axis at 125 mm/s
+    'move': 0.3,  # Acceleration and command overhead of each movement
+    'plunger_s': 1.0,  # Volume / flow rate
+    'delay_s': 1.0,  # ctx.delay
+    'pick_up': 2.5,  # Tip pressing
+    'drop': 2.0,  # Tip ejection and plunger homing
+    'blow_out': 0.8,
+    'touch_tip': 2.0,
+    'engage': 3.0,
+    'disengage': 3.0,
+    'home': 10.0,
+}
+FEATURES = list(COEFFICIENTS)
+FIXED_OPS = ['pick_up', 'drop', 'blow_out', 'touch_tip', 'engage', 'disengage', 'home']
+PLUNGER_OPS = [recorder.OP_CODE[op] for op in ['aspirate', 'dispense', 'air_gap']]
+
+ARC_CLEARANCE = 10  # mm the head rises over the higher of two wells when moving between them
+SAME_WELL = 0.5  # mm of xy distance under which a movement is a straight z move
+
+TOOK = re.compile(r'Step (\d+): .* took (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+def features(log):
+    '''
+    Feature matrix of the commands of a CommandLog, one row per command and one column per
+    feature in FEATURES. Commands without location (delays, magnet, pauses) leave the head where
+    it was.
+    '''
+    op = log.column('op')
+    value = log.column('value')
+    rate = log.column('rate')
+    located = log.column('well') >= 0
+    f = np.zeros((len(op), len(FEATURES)))
+    # Last known head position of each command
+    last = np.maximum.accumulate(np.where(located, np.arange(len(op)), 0))
+    position = np.stack([log.column('x'), log.column('y'), log.column('z')], axis = 1)[last]
+    previous = np.vstack([position[:1], position[:-1]])
+    xy = np.linalg.norm(position[:, :2] - previous[:, :2], axis = 1)
+    arc = np.maximum(position[:, 2], previous[:, 2]) + ARC_CLEARANCE
+    z = np.where(xy > SAME_WELL, (arc - previous[:, 2]) + (arc - position[:, 2]),
+                 np.abs(position[:, 2] - previous[:, 2]))
+    moved = located & ((xy > SAME_WELL) | (z > 0))
+    f[:, FEATURES.index('xy_mm')] = np.where(moved, xy, 0)
+    f[:, FEATURES.index('z_mm')] = np.where(moved, z, 0)
+    f[:, FEATURES.index('move')] = moved
+    plunger = np.isin(op, PLUNGER_OPS) & (rate > 0)
+    f[plunger, FEATURES.index('plunger_s')] = value[plunger] / rate[plunger]
+    delay = op == recorder.OP_CODE['delay']
+    f[delay, FEATURES.index('delay_s')] = value[delay]
+    for name in FIXED_OPS:
+        f[:, FEATURES.index(name)] = op == recorder.OP_CODE[name]
+    return f
+
+
+def command_seconds(log, coefficients = None):
+    '''
+    Predicted seconds of each command of a CommandLog
+    '''
+    c = dict(COEFFICIENTS, **(coefficients or {}))
+    return features(log) @ np.array([c[name] for name in FEATURES])
+
+
+def column_shares(log):
+    '''
+    Sample plate columns served by each command: a tip cycle (pick up to drop) is shared by the
+    sample plate columns it touches. Returns the list of columns of each command, empty for the
+    commands that serve the whole run (delays, magnet, reagent preparation).
+    '''
+    op = log.column('op')
+    well = log.column('well')
+    plate_column = np.array(log.well_columns + [-1])[well]  # well -1 takes the trailing -1
+    shares = [[] for _ in range(len(op))]
+    cycle = []
+    for i in range(len(op)):
+        if op[i] == recorder.OP_CODE['pick_up']:
+            cycle = [i]
+        elif cycle:
+            cycle.append(i)
+            if op[i] == recorder.OP_CODE['drop']:
+                columns = sorted(set(plate_column[cycle]) - {-1})
+                for j in cycle:
+                    shares[j] = columns
+                cycle = []
+    for i in range(len(op)):
+        if not shares[i] and plate_column[i] >= 0:
+            shares[i] = [int(plate_column[i])]
+    return shares
+
+
+def estimate(ctx, coefficients = None):
+    '''
+    Predicted seconds of a recorded run (a RecordingContext): total, per step and per sample
+    column. Commands that serve the whole run are reported as the 'shared' column.
+    '''
+    seconds = command_seconds(ctx.log, coefficients)
+    steps = ctx.log.column('step')
+    per_step = {int(s): float(seconds[steps == s].sum()) for s in np.unique(steps)}
+    per_column = {'shared': 0.0}
+    for t, columns in zip(seconds, column_shares(ctx.log)):
+        if not columns:
+            per_column['shared'] += t
+        for c in columns:
+            per_column[c + 1] = per_column.get(c + 1, 0) + t / len(columns)
+    return {'total': float(seconds.sum()), 'steps': per_step, 'columns': per_column,
+            'pauses': len(ctx.pauses)}
+
+
+def step_descriptions(ctx):
+    '''
+    Description of each step, from the 'Step N: description took H:MM:SS' comments of the run
+    '''
+    descriptions = {0: 'Before the first step'}
+    for comment in ctx.comments:
+        step = recorder.STEP_COMMENT.match(comment)
+        if step and ' took ' in comment:
+            descriptions[int(step.group(1))] = comment[step.end():].rsplit(' took ', 1)[0]
+    return descriptions
+
+
+####################################
+# Fitting
+####################################
+def read_step_times(path):
+    '''
+    Seconds taken by each step of a real run, summed over the plates of a continuous run. Reads
+    a tsv time log (STEP and execution_time columns), the step_end records of an event journal
+    (.jsonl) or the 'Step N: ... took H:MM:SS' comments of a run log.
+    '''
+    times = {}
+    with open(path, encoding = 'utf-8') as f:
+        lines = f.read().splitlines()
+    if path.endswith('.jsonl'):
+        for line in lines:
+            record = json.loads(line)
+            if record['event'] == 'step_end':
+                times[record['step']] = times.get(record['step'], 0) + record['seconds']
+    elif lines and lines[0].startswith('STEP\t'):
+        header = lines[0].split('\t')
+        for line in lines[1:]:
+            row = dict(zip(header, line.split('\t')))
+            taken = row.get('execution_time', '')
+            if taken.count(':') == 2:
+                h, m, s = taken.split(':')
+                step = int(row['STEP'].split('.')[-1])  # <plate>.<step> in continuous runs
+                times[step] = times.get(step, 0) + int(h) * 3600 + int(m) * 60 + float(s)
+    else:
+        for line in lines:
+            took = TOOK.search(line)
+            if took:
+                step = int(took.group(1))
+                times[step] = (times.get(step, 0) + int(took.group(2)) * 3600 + int(took.group(3)) * 60 +
+                               float(took.group(4)))
+    return times
+
+
+def fit(runs, regularization = 0.1):
+    '''
+    Coefficients that best predict the step times of real runs.
+    runs: list of (protocol path, time log path, variables of the run).
+    The fit is a least squares on the ratio of each coefficient to its default, pulled towards the
+    defaults by regularization so that features that the runs barely exercise keep sensible
+    values. Returns the coefficients and the observations as (run, step, measured, default
+    prediction, fitted prediction).
+    '''
+    rows, measured, labels = [], [], []
+    for protocol, log_path, variables in runs:
+        ctx = recorder.simulate(protocol, **variables)
+        f = features(ctx.log)
+        steps = ctx.log.column('step')
+        for step, seconds in sorted(read_step_times(log_path).items()):
+            if np.any(steps == step):
+                rows.append(f[steps == step].sum(axis = 0))
+                measured.append(seconds)
+                labels.append((log_path, step))
+    if not rows:
+        raise ValueError('No step of the time logs matches a step of the protocols')
+    defaults = np.array([COEFFICIENTS[name] for name in FEATURES])
+    a = np.array(rows) * defaults
+    t = np.array(measured)
+    scale = regularization * np.maximum(np.diag(a.T @ a), 1e-9)
+    ratio = np.linalg.solve(a.T @ a + np.diag(scale), a.T @ t + scale)
+    ratio = np.maximum(ratio, 0)
+    fitted = defaults * ratio
+    observations = [(run, step, m, float(r @ defaults), float(r @ fitted))
+                    for (run, step), m, r in zip(labels, measured, rows)]
+    return dict(zip(FEATURES, fitted.tolist())), observations
+
+
+####################################
+# Command line
+####################################
+def hms(seconds):
+    return str(timedelta(seconds = round(seconds)))
+
+
+def main(argv = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['fit']:
+        parser = argparse.ArgumentParser(prog = 'tools.estimator fit', description = 'Fit the timing model to real runs')
+        parser.add_argument('--run', action = 'append', required = True,
+                            help = '"PROTOCOL TIME_LOG NAME=value ..." of a real run, can be repeated')
+        parser.add_argument('--regularization', type = float, default = 0.1)
+        parser.add_argument('--out', help = 'json file to save the coefficients to')
+        options = parser.parse_args(argv[1:])
+        runs = []
+        for run in options.run:
+            words = shlex.split(run)
+            runs.append((words[0], words[1], recorder.parse_variables(words[2:])))
+        coefficients, observations = fit(runs, options.regularization)
+        print('run\tstep\tmeasured\tdefault_model\tfitted_model')
+        for run, step, m, default, fitted in observations:
+            print('\t'.join([run, str(step), hms(m), hms(default), hms(fitted)]))
+        print(json.dumps(coefficients, indent = 1))
+        if options.out:
+            with open(options.out, 'w') as f:
+                json.dump(coefficients, f, indent = 1)
+        return 0
+
+    parser = argparse.ArgumentParser(description = 'Estimate the run time of a station protocol')
+    parser.add_argument('args', nargs = '+', help = 'protocol file and NAME=value variables')
+    parser.add_argument('--coefficients', help = 'json file with fitted coefficients')
+    options = parser.parse_args(argv)
+    path = [a for a in options.args if '=' not in a][0]
+    variables = recorder.parse_variables([a for a in options.args if '=' in a])
+    coefficients = None
+    if options.coefficients:
+        with open(options.coefficients) as f:
+            coefficients = json.load(f)
+    ctx = recorder.simulate(path, **variables)
+    result = estimate(ctx, coefficients)
+    descriptions = step_descriptions(ctx)
+    print('step\tdescription\ttime')
+    for step, seconds in result['steps'].items():
+        print(str(step) + '\t' + descriptions.get(step, '') + '\t' + hms(seconds))
+    print('column\ttime')
+    for column, seconds in result['columns'].items():
+        print(str(column) + '\t' + hms(seconds))
+    print('Total: ' + hms(result['total']) + (' plus ' + str(result['pauses']) + ' pauses' if result['pauses'] else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,618 @@
+'''
+Recording stand-in for the opentrons ProtocolContext.
+
+Runs a station protocol off-robot with fake labware, modules, pipettes and gpio, and records every
+robot command (tip pickups and drops, aspirations, dispenses, moves, delays...) in a CommandLog.
+The context reports is_simulating() as True, so nothing is written to the robot folders, and the
+light loops do not sleep.
+
+    python -m tools.recorder MAGMAX/Station_B.py NUM_SAMPLES=48
+    python -m tools.recorder --samples 1-96        # every kit, station and NUM_SAMPLES
+'''
+import argparse
+import ast
+import contextlib
+import glob
+import os
+import re
+import sys
+import time
+import types
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Command types of the log, the op column holds their index
+OPS = ('pick_up', 'drop', 'aspirate', 'dispense', 'blow_out', 'touch_tip', 'air_gap', 'move', 'delay',
+       'pause', 'engage', 'disengage', 'set_temperature', 'await_temperature', 'home')
+OP_CODE = {op: i for i, op in enumerate(OPS)}
+
+STEP_COMMENT = re.compile(r'Step (\d+): ')
+
+####################################
+# Approximate deck geometry, in mm
+####################################
+SLOT_SIZE = (132.5, 90.5)  # Slot 1 is at the origin, slots go left to right and front to back
+MODULE_HEIGHT = {'magdeck': 35, 'tempdeck': 80}  # Labware on a module is raised by this much
+BOTTOM_CLEARANCE = 1  # Height over the well bottom of aspirations and dispenses given a well
+
+# load name: rows, columns, well spacing, A1 x and y in the slot, labware height, well depth
+LABWARE = {
+    'opentrons_96_tiprack_300ul': (8, 12, 9, 14.38, 74.24, 64.5, 59.3),
+    'opentrons_96_filtertiprack_20ul': (8, 12, 9, 14.38, 74.24, 64.7, 39.2),
+    'opentrons_96_filtertiprack_200ul': (8, 12, 9, 14.38, 74.24, 64.5, 59.3),
+    'opentrons_96_filtertiprack_1000ul': (8, 12, 9, 14.38, 74.24, 97.5, 88),
+    'nest_96_wellplate_2000ul': (8, 12, 9, 14.38, 74.24, 41, 38),
+    'abgene_96_wellplate_800ul': (8, 12, 9, 14.38, 74.24, 27.3, 25),
+    'kingfisher_std_96_wellplate_550ul': (8, 12, 9, 14.38, 74.24, 22.5, 20.7),
+    'abi_fast_qpcr_96_alum_opentrons_100ul': (8, 12, 9, 14.38, 74.24, 20.3, 16.1),
+    'biorad_96_alum': (8, 12, 9, 14.38, 74.24, 20.3, 16.1),
+    'opentrons_96_aluminumblock_generic_pcr_strip_200ul': (8, 12, 9, 14.38, 74.24, 49.4, 20.2),
+    'biorad_384_wellplate_50ul': (16, 24, 4.5, 12.13, 76.48, 10.4, 9.4),
+    'nest_12_reservoir_15ml': (1, 12, 9, 14.38, 42.78, 31.4, 26.9),
+    'nest_1_reservoir_195ml': (1, 1, 9, 63.88, 42.74, 31.4, 25),
+    'opentrons_24_tuberack_generic_2ml_screwcap': (4, 6, 19.89, 18.21, 75.43, 84, 42),
+    'opentrons_24_aluminumblock_generic_2ml_screwcap': (4, 6, 17.25, 20.75, 68.63, 42, 39.3),
+    'opentrons_6_tuberack_falcon_50ml_conical': (2, 3, 35, 35.5, 60.5, 113, 112),
+    'opentrons_1_trash_1100ml_fixed': (1, 1, 9, 82.84, 80, 82, 0),
+}
+
+# Layout of unknown labware from the number of wells in its load name
+WELL_FORMATS = {384: (16, 24, 4.5), 96: (8, 12, 9), 24: (4, 6, 19.3), 12: (1, 12, 9), 6: (2, 3, 35), 1: (1, 1, 9)}
+
+# name: max volume, channels and default aspirate, dispense and blow out flow rates (µl/s)
+PIPETTES = {
+    'p20_single_gen2': (20, 1, 7.6, 7.6, 7.6),
+    'p20_multi_gen2': (20, 8, 7.6, 7.6, 7.6),
+    'p300_single_gen2': (300, 1, 92.86, 92.86, 92.86),
+    'p300_multi_gen2': (300, 8, 94, 94, 94),
+    'p1000_single_gen2': (1000, 1, 274.7, 274.7, 274.7),
+}
+
+
+class OutOfTipsError(Exception):
+    pass
+
+
+class Point(namedtuple('Point', 'x y z')):
+    def __new__(cls, x = 0, y = 0, z = 0):
+        return super().__new__(cls, x, y, z)
+
+    def __add__(self, other):
+        return Point(self.x + other.x, self.y + other.y, self.z + other.z)
+
+
+class Location(namedtuple('Location', 'point labware')):
+    def move(self, point):
+        return Location(self.point + point, self.labware)
+
+
+####################################
+# Command log
+####################################
+class CommandLog:
+    '''
+    Commands of a run in typed arrays, one row per command: op (index in OPS), pipette (index in
+    pipettes, -1 for none), value (µl, seconds, mm or °C, depending on the op), rate (flow rate in
+    µl/s), the x, y, z of the location, well (index in wells, -1 for none) and the last step the
+    protocol announced in its comments. well_columns holds the column of each well in its sample
+    plate, -1 for tipracks, tubes, reservoirs and the trash, and well_labware its labware load name.
+    '''
+    FIELDS = (('op', 'b'), ('pipette', 'b'), ('value', 'd'), ('rate', 'd'), ('x', 'd'), ('y', 'd'),
+              ('z', 'd'), ('well', 'i'), ('step', 'h'))
+
+    def __init__(self):
+        self.data = {name: array(code) for name, code in self.FIELDS}
+        self.pipettes = []  # Names of the pipettes
+        self.wells = []  # Display names of the wells
+        self.well_columns = []
+        self.well_labware = []
+        self.well_index = {}
+
+    def __len__(self):
+        return len(self.data['op'])
+
+    def append(self, op, pipette = -1, value = 0, rate = 0, location = None, step = 0):
+        d = self.data
+        d['op'].append(OP_CODE[op])
+        d['pipette'].append(pipette)
+        d['value'].append(value or 0)
+        d['rate'].append(rate)
+        if location is None:
+            point, well = Point(), -1
+        else:
+            point = location.point
+            name = location.labware.display_name
+            well = self.well_index.get(name)
+            if well is None:
+                well = self.well_index[name] = len(self.wells)
+                self.wells.append(name)
+                self.well_columns.append(location.labware.plate_column)
+                self.well_labware.append(location.labware.parent.load_name)
+        d['x'].append(point.x)
+        d['y'].append(point.y)
+        d['z'].append(point.z)
+        d['well'].append(well)
+        d['step'].append(step)
+
+    def column(self, name):
+        '''
+        Copy of a column as a numpy array
+        '''
+        return np.frombuffer(self.data[name], dtype = self.data[name].typecode).copy()
+
+    def counts(self):
+        '''
+        Number of commands of each op
+        '''
+        return dict(zip(OPS, np.bincount(self.column('op'), minlength = len(OPS)).tolist()))
+
+    def summary(self):
+        '''
+        Command counts, volume moved and time waited in delays
+        '''
+        op, value = self.column('op'), self.column('value')
+        summary = {'commands': len(self)}
+        summary.update(self.counts())
+        summary['aspirated_ul'] = float(value[op == OP_CODE['aspirate']].sum())
+        summary['delay_s'] = float(value[op == OP_CODE['delay']].sum())
+        return summary
+
+
+####################################
+# Labware, modules and pipettes
+####################################
+class Well:
+    def __init__(self, labware, name, top, depth):
+        self.parent = labware
+        self.well_name = name
+        self.top_point = top
+        self.depth = depth
+
+    def __repr__(self):
+        return self.display_name
+
+    @property
+    def display_name(self):
+        return self.well_name + ' of ' + self.parent.label + ' on ' + str(self.parent.parent)
+
+    def top(self, z = 0):
+        return Location(self.top_point + Point(z = z), self)
+
+    def bottom(self, z = 0):
+        return Location(self.top_point + Point(z = z - self.depth), self)
+
+    def center(self):
+        return self.bottom(self.depth / 2)
+
+    @property
+    def plate_column(self):
+        '''
+        Column of the well (0 based) if it is in a sample plate, -1 otherwise
+        '''
+        if self.parent.is_sample_plate:
+            return int(self.well_name[1:]) - 1
+        return -1
+
+
+class Labware:
+    def __init__(self, load_name, slot, label = None, base = 0):
+        if load_name in LABWARE:
+            rows, columns, spacing, x, y, height, depth = LABWARE[load_name]
+        else:
+            size = max([int(n) for n in re.findall(r'_(\d+)_', load_name) if int(n) in WELL_FORMATS] or [96])
+            rows, columns, spacing = WELL_FORMATS[size]
+            x, y, height, depth = 14.38, 74.24, 50, 40
+        self.load_name = load_name
+        self.parent = str(slot)
+        self.label = label or load_name
+        # Deepwell, elution and qPCR plates, where each column holds samples
+        self.is_sample_plate = rows >= 8 and 'tiprack' not in load_name and 'strip' not in load_name
+        origin_x = (int(slot) - 1) % 3 * SLOT_SIZE[0]
+        origin_y = (int(slot) - 1) // 3 * SLOT_SIZE[1]
+        self._rows = [[Well(self, 'ABCDEFGHIJKLMNOP'[r] + str(c + 1),
+                            Point(origin_x + x + c * spacing, origin_y + y - r * spacing, base + height), depth)
+                       for c in range(columns)] for r in range(rows)]
+        self.used_tips = set()
+
+    def __repr__(self):
+        return self.label + ' on ' + self.parent
+
+    def __getitem__(self, name):
+        return self.wells_by_name()[name]
+
+    def rows(self):
+        return [list(row) for row in self._rows]
+
+    def columns(self):
+        return [list(column) for column in zip(*self._rows)]
+
+    def wells(self):
+        return [w for column in zip(*self._rows) for w in column]
+
+    def wells_by_name(self):
+        return {w.well_name: w for row in self._rows for w in row}
+
+    def use_tips(self, start_well, num_channels = 1):
+        wells = self.wells()
+        start = wells.index(start_well)
+        self.used_tips.update(wells[start:start + num_channels])
+
+    def next_tip(self, num_tips = 1):
+        '''
+        First well with num_tips unused tips below it in its column, None if there is none
+        '''
+        for column in self.columns():
+            for start in range(len(column) - num_tips + 1):
+                if not any(w in self.used_tips for w in column[start:start + num_tips]):
+                    return column[start]
+        return None
+
+    def reset(self):
+        self.used_tips = set()
+
+
+class MagneticModule:
+    def __init__(self, ctx, slot):
+        self.ctx = ctx
+        self.slot = slot
+        self.status = 'disengaged'
+
+    def load_labware(self, name, label = None):
+        return Labware(name, self.slot, label, MODULE_HEIGHT['magdeck'])
+
+    def engage(self, height = None, offset = None, height_from_base = None):
+        self.status = 'engaged'
+        self.ctx.record('engage', value = height if height is not None else height_from_base)
+
+    def disengage(self):
+        self.status = 'disengaged'
+        self.ctx.record('disengage')
+
+
+class TemperatureModule:
+    def __init__(self, ctx, slot):
+        self.ctx = ctx
+        self.slot = slot
+        self.target = None
+        self.temperature = 25
+        self.status = 'idle'
+
+    def load_labware(self, name, label = None):
+        return Labware(name, self.slot, label, MODULE_HEIGHT['tempdeck'])
+
+    def start_set_temperature(self, celsius):
+        self.target = celsius
+        self.status = 'holding at target'
+        self.ctx.record('set_temperature', value = celsius)
+
+    def await_temperature(self, celsius):
+        self.temperature = celsius
+        self.ctx.record('await_temperature', value = celsius)
+
+    def set_temperature(self, celsius):
+        self.start_set_temperature(celsius)
+        self.await_temperature(celsius)
+
+    def deactivate(self):
+        self.target = None
+        self.status = 'idle'
+
+
+class Pipette:
+    def __init__(self, ctx, name, mount, tip_racks):
+        max_volume, channels, aspirate, dispense, blow_out = PIPETTES[name]
+        self.ctx = ctx
+        self.name = name
+        self.mount = mount
+        self.tip_racks = list(tip_racks)
+        self.max_volume = max_volume
+        self.channels = channels
+        self.flow_rate = types.SimpleNamespace(aspirate = aspirate, dispense = dispense, blow_out = blow_out)
+        self.hw_pipette = {'has_tip': False}
+        self.current_volume = 0
+        self.location = None
+        self.tip = None  # Tiprack well of the tip on the pipette
+        self.index = len(ctx.log.pipettes)
+        ctx.log.pipettes.append(name)
+
+    def __repr__(self):
+        return self.name + ' on ' + self.mount + ' mount'
+
+    def _at(self, location, z = BOTTOM_CLEARANCE):
+        '''
+        Location of a command: a well is taken at z over its bottom, no location is where the
+        pipette already is
+        '''
+        if location is None:
+            location = self.location
+        elif isinstance(location, Well):
+            location = location.bottom(z)
+        self.location = location
+        return location
+
+    def _record(self, op, value = 0, rate = 0, location = None):
+        self.ctx.record(op, self.index, value, rate, location)
+        return self
+
+    def _check_tip(self, action):
+        if not self.hw_pipette['has_tip']:
+            raise RuntimeError('Cannot ' + action + ' without a tip on ' + self.name)
+
+    def aspirate(self, volume = None, location = None, rate = 1.0):
+        self._check_tip('aspirate')
+        if volume is None:
+            volume = self.max_volume - self.current_volume
+        if self.current_volume + volume > self.max_volume + 1e-6:
+            raise RuntimeError('Cannot aspirate ' + str(volume) + 'µl with ' + str(self.current_volume) +
+                               'µl already in ' + self.name)
+        self.current_volume += volume
+        return self._record('aspirate', volume, self.flow_rate.aspirate * rate, self._at(location))
+
+    def dispense(self, volume = None, location = None, rate = 1.0):
+        self._check_tip('dispense')
+        if volume is None:
+            volume = self.current_volume
+        self.current_volume = max(0, self.current_volume - volume)
+        return self._record('dispense', volume, self.flow_rate.dispense * rate, self._at(location))
+
+    def blow_out(self, location = None):
+        self._check_tip('blow out')
+        self.current_volume = 0
+        location = location.top() if isinstance(location, Well) else location
+        return self._record('blow_out', 0, self.flow_rate.blow_out, self._at(location))
+
+    def touch_tip(self, location = None, radius = 1.0, v_offset = -1.0, speed = 60.0):
+        self._check_tip('touch tip')
+        well = location if isinstance(location, Well) else self._at(None).labware
+        return self._record('touch_tip', speed, 0, self._at(well.top(v_offset)))
+
+    def air_gap(self, volume = None, height = None):
+        self._check_tip('air gap')
+        volume = self.max_volume - self.current_volume if volume is None else volume
+        self.current_volume += volume
+        well = self._at(None).labware
+        return self._record('air_gap', volume, self.flow_rate.aspirate,
+                            self._at(well.top(5 if height is None else height)))
+
+    def mix(self, repetitions = 1, volume = None, location = None, rate = 1.0):
+        for _ in range(repetitions):
+            self.aspirate(volume, location, rate)
+            self.dispense(volume, None, rate)
+        return self
+
+    def move_to(self, location, force_direct = False, minimum_z_height = None, speed = None):
+        return self._record('move', speed or 0, 0, self._at(location))
+
+    def next_tip(self):
+        '''
+        First tip (the first of a whole free column for a multichannel) left in the tipracks
+        '''
+        for rack in self.tip_racks:
+            for column in rack.columns():
+                free = [w for w in column if w not in rack.used_tips]
+                if self.channels == 1 and free:
+                    return free[0]
+                if len(free) == len(column):
+                    return column[0]
+        raise OutOfTipsError('No tips left in the tipracks of ' + self.name)
+
+    def pick_up_tip(self, location = None, presses = None, increment = None):
+        if self.hw_pipette['has_tip']:
+            raise RuntimeError('Cannot pick up a tip, ' + self.name + ' already has one')
+        if location is None:
+            well = self.next_tip()
+        else:
+            well = location if isinstance(location, Well) else location.labware
+        rack = well.parent
+        column = [w for w in rack.columns()[int(well.well_name[1:]) - 1]]
+        start = column.index(well)
+        rack.used_tips.update(column[start:start + self.channels])
+        self.hw_pipette['has_tip'] = True
+        self.tip = well
+        return self._record('pick_up', 0, 0, self._at(well.top()))
+
+    def drop_tip(self, location = None, home_after = True):
+        self._check_tip('drop tip')
+        if location is None:
+            location = self.ctx.fixed_trash.wells()[0].top()
+        elif isinstance(location, Well):
+            location = location.top()
+        self.hw_pipette['has_tip'] = False
+        self.current_volume = 0
+        self.tip = None
+        return self._record('drop', 0, 0, self._at(location))
+
+    def return_tip(self, home_after = True):
+        return self.drop_tip(self.tip, home_after)
+
+    def reset_tipracks(self):
+        for rack in self.tip_racks:
+            rack.reset()
+
+
+class RecordingContext:
+    '''
+    Stand-in for opentrons.protocol_api.ProtocolContext that records the commands in self.log,
+    the comments in self.comments and the pause messages in self.pauses
+    '''
+    def __init__(self):
+        self.log = CommandLog()
+        self.comments = []
+        self.pauses = []
+        self.step = 0  # Last step announced by a 'Step N: ...' comment
+        self.fixed_trash = Labware('opentrons_1_trash_1100ml_fixed', '12', 'Trash')
+
+    def is_simulating(self):
+        return True
+
+    def record(self, op, pipette = -1, value = 0, rate = 0, location = None):
+        self.log.append(op, pipette, value, rate, location, self.step)
+
+    def comment(self, msg):
+        self.comments.append(msg)
+        step = STEP_COMMENT.match(msg)
+        if step:
+            self.step = int(step.group(1))
+
+    def delay(self, seconds = 0, minutes = 0, msg = None):
+        self.record('delay', value = seconds + 60 * minutes)
+
+    def pause(self, msg = None):
+        self.pauses.append(msg)
+        self.record('pause')
+
+    def home(self):
+        self.record('home')
+
+    def load_labware(self, load_name, location, label = None):
+        return Labware(load_name, location, label)
+
+    def load_module(self, module_name, location):
+        if 'mag' in module_name.lower():
+            return MagneticModule(self, location)
+        return TemperatureModule(self, location)
+
+    def load_instrument(self, instrument_name, mount, tip_racks = ()):
+        return Pipette(self, instrument_name, mount, tip_racks)
+
+
+####################################
+# Running the protocols
+####################################
+@contextlib.contextmanager
+def stand_in_modules():
+    '''
+    Temporarily replaces the opentrons modules the protocols import with the stand-ins
+    '''
+    names = ['opentrons', 'opentrons.types', 'opentrons.protocol_api', 'opentrons.drivers',
+             'opentrons.drivers.rpi_drivers', 'opentrons.drivers.rpi_drivers.gpio']
+    saved = {name: sys.modules.get(name) for name in names}
+    modules = {name: types.ModuleType(name) for name in names}
+    modules['opentrons.types'].Point = Point
+    modules['opentrons.types'].Location = Location
+    modules['opentrons.protocol_api'].ProtocolContext = RecordingContext
+    gpio = modules['opentrons.drivers.rpi_drivers.gpio']
+    gpio.set_button_light = lambda red = False, green = False, blue = False: None
+    gpio.set_rail_lights = lambda on = True: None
+    for name in names[1:]:
+        parent, child = name.rsplit('.', 1)
+        setattr(modules[parent], child, modules[name])
+    sys.modules.update(modules)
+    try:
+        yield
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+
+# The protocols flash the lights with time.sleep at the end, their time module does not sleep
+quiet_time = types.SimpleNamespace(**{name: getattr(time, name) for name in dir(time) if not name.startswith('_')})
+quiet_time.sleep = lambda seconds: None
+
+
+def load_protocol(path, **variables):
+    '''
+    Loads the protocol at path as a module. The module level variables in variables are set in
+    the source, before anything is calculated from them. Only single line variables can be set.
+    '''
+    with open(path, encoding = 'utf-8') as f:
+        source = f.read()
+    for name, value in variables.items():
+        source, found = re.subn(r'^(' + re.escape(name) + r'\s*=\s*)([^#\n]*?)(\s*#.*)?$',
+                                lambda m: m.group(1) + repr(value) + (m.group(3) or ''),
+                                source, count = 1, flags = re.M)
+        if not found:
+            raise KeyError(name + ' is not a variable of ' + path)
+    protocol = types.ModuleType(os.path.splitext(os.path.basename(path))[0])
+    protocol.__file__ = path
+    with stand_in_modules():
+        exec(compile(source, path, 'exec'), protocol.__dict__)
+    protocol.time = quiet_time
+    return protocol
+
+
+def simulate(path, **variables):
+    '''
+    Runs the protocol at path, with its variables set as in load_protocol, in a RecordingContext.
+    Returns the context, with the commands in ctx.log.
+    '''
+    protocol = load_protocol(path, **variables)
+    ctx = RecordingContext()
+    with stand_in_modules():
+        protocol.run(ctx)
+    return ctx
+
+
+def protocols():
+    '''
+    Paths of the protocols of every station of every kit
+    '''
+    return sorted(glob.glob(os.path.join(REPO, '*', 'Station_[ABC].py')))
+
+
+def parse_variables(assignments):
+    '''
+    Variables from NAME=value arguments, values are python literals or plain strings
+    '''
+    variables = {}
+    for assignment in assignments:
+        name, value = assignment.split('=', 1)
+        try:
+            variables[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            variables[name] = value
+    return variables
+
+
+def parse_samples(spec):
+    '''
+    NUM_SAMPLES values from a list of numbers and ranges, i.e. '8,48,90-96'
+    '''
+    samples = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        samples += list(range(int(first), int(last or first) + 1))
+    return samples
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Record the commands of station protocols off-robot')
+    parser.add_argument('args', nargs = '*', help = 'protocol files (every protocol if none) and NAME=value variables')
+    parser.add_argument('--samples', help = 'NUM_SAMPLES values to run, i.e. 8,48,96 or 1-96')
+    options = parser.parse_args(argv)
+    paths = [a for a in options.args if '=' not in a] or protocols()
+    variables = parse_variables([a for a in options.args if '=' in a])
+    samples = parse_samples(options.samples) if options.samples else [variables.get('NUM_SAMPLES')]
+    failed = 0
+    slowest = (0, None)
+    print('protocol\tNUM_SAMPLES\tcommands\tpick_up\taspirate\tdispense\tdelay_s\tpauses\tseconds')
+    for path in paths:
+        for n in samples:
+            run_variables = dict(variables, **({'NUM_SAMPLES': n} if n is not None else {}))
+            start = time.perf_counter()
+            try:
+                ctx = simulate(path, **run_variables)
+            except Exception as e:
+                failed += 1
+                print(os.path.relpath(path, REPO) + '\t' + str(n) + '\tERROR ' + type(e).__name__ + ': ' + str(e))
+                continue
+            elapsed = time.perf_counter() - start
+            slowest = max(slowest, (elapsed, os.path.relpath(path, REPO) + ' NUM_SAMPLES=' + str(n)))
+            summary = ctx.log.summary()
+            print('\t'.join(str(v) for v in [os.path.relpath(path, REPO), n, summary['commands'], summary['pick_up'],
+                                            summary['aspirate'], summary['dispense'], round(summary['delay_s']),
+                                            summary['pause'], round(elapsed, 3)]))
+    if slowest[1]:
+        print('Slowest: ' + slowest[1] + ' in ' + str(round(slowest[0], 3)) + ' s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
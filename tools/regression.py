@@ -0,0 +1,134 @@
+'''
+Golden command stream regression guard.
+
+Records the command counts, the gantry travel and the delay seconds of every protocol at
+reference NUM_SAMPLES values and optional modes (see tools/recorder.py) into tools/golden.json,
+and checks later versions of the protocols against it. An extra move_to or air gap per transfer
+in move_vol_multi, custom_mix or distribute_custom shows up as a larger count, and the check
+fails with a table of what grew.
+
+    python -m tools.regression              # check, exits with 1 if a figure grew over the tolerance
+    python -m tools.regression --tolerance 0.05
+    python -m tools.regression record       # accept the current figures as the new golden ones
+'''
+import argparse
+import json
+import os
+import sys
+
+from tools import estimator, recorder
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden.json')
+REFERENCE_SAMPLES = [8, 48, 96]
+# Extra reference runs of the optional modes of each station
+REFERENCE_VARIABLES = {
+    'Station_C.py': [{'NUM_SAMPLES': 96, 'mmix_multichannel': True}, {'NUM_SAMPLES': 96, 'pcr_384': True}],
+}
+TOLERANCE = 0.01  # Relative growth allowed before the check fails
+
+
+def figures(ctx):
+    '''
+    Regression figures of a recorded run: number of commands of each op, gantry travel in mm
+    and seconds of delays
+    '''
+    f = estimator.features(ctx.log)
+    result = {'commands': len(ctx.log)}
+    result.update({op: n for op, n in ctx.log.counts().items() if n})
+    result['travel_mm'] = round(float(f[:, estimator.FEATURES.index('xy_mm')].sum() +
+                                      f[:, estimator.FEATURES.index('z_mm')].sum()), 1)
+    result['delay_s'] = round(float(ctx.log.summary()['delay_s']), 1)
+    return result
+
+
+def reference_runs(paths = None, samples = None):
+    '''
+    Figures of every protocol at every reference NUM_SAMPLES and in the modes of
+    REFERENCE_VARIABLES, by '<kit>/<station> NAME=value ...'. Runs that fail keep their error instead.
+    '''
+    runs = {}
+    for path in paths or recorder.protocols():
+        configurations = ([{'NUM_SAMPLES': n} for n in samples or REFERENCE_SAMPLES] +
+                          REFERENCE_VARIABLES.get(os.path.basename(path), []))
+        for variables in configurations:
+            name = (os.path.relpath(path, recorder.REPO).replace(os.sep, '/') + ' ' +
+                    ' '.join(key + '=' + str(value) for key, value in variables.items()))
+            try:
+                runs[name] = figures(recorder.simulate(path, **variables))
+            except Exception as e:
+                runs[name] = {'error': type(e).__name__ + ': ' + str(e)}
+    return runs
+
+
+def compare(golden, current, tolerance = TOLERANCE):
+    '''
+    Differences between two sets of reference runs, as (run, figure, golden, current, regression)
+    regression is True for the figures that grew over the tolerance, new errors and missing runs
+    '''
+    differences = []
+    for run in sorted(set(golden) | set(current)):
+        if run not in current:
+            differences.append((run, 'run', 'recorded', 'missing', True))
+            continue
+        if run not in golden:
+            differences.append((run, 'run', 'missing', 'new', False))
+            continue
+        old, new = golden[run], current[run]
+        if 'error' in old or 'error' in new:
+            if old.get('error') != new.get('error'):
+                differences.append((run, 'error', old.get('error', ''), new.get('error', ''), 'error' in new))
+            continue
+        for figure in sorted(set(old) | set(new), key = lambda k: (k not in ('commands', 'travel_mm', 'delay_s'), k)):
+            before, after = old.get(figure, 0), new.get(figure, 0)
+            if after != before:
+                differences.append((run, figure, before, after, after > before * (1 + tolerance)))
+    return differences
+
+
+def report(differences):
+    '''
+    Readable table of the differences, regressions first
+    '''
+    lines = []
+    for regression in (True, False):
+        rows = [d for d in differences if d[4] == regression]
+        if not rows:
+            continue
+        lines.append('Regressions:' if regression else 'Other changes (within the tolerance or lower):')
+        width = max(len(run) for run, *_ in rows)
+        for run, figure, before, after, _ in rows:
+            change = ''
+            if isinstance(before, (int, float)) and isinstance(after, (int, float)):
+                change = ('{:+.1%}'.format(after / before - 1) if before else 'new')
+            lines.append('  ' + run.ljust(width) + '  ' + figure.ljust(10) + ' ' + str(before) + ' -> ' + str(after) +
+                         ('  (' + change + ')' if change else ''))
+    return '\n'.join(lines)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Check the command streams of the protocols against the golden figures')
+    parser.add_argument('action', nargs = '?', choices = ['check', 'record'], default = 'check')
+    parser.add_argument('--golden', default = GOLDEN, help = 'json file with the golden figures')
+    parser.add_argument('--tolerance', type = float, default = TOLERANCE,
+                        help = 'relative growth allowed, i.e. 0.01 for 1%%')
+    options = parser.parse_args(argv)
+    current = reference_runs()
+    if options.action == 'record':
+        with open(options.golden, 'w') as f:
+            json.dump(current, f, indent = 1, sort_keys = True)
+            f.write('\n')
+        print('Recorded ' + str(len(current)) + ' reference runs to ' + options.golden)
+        return 0
+    with open(options.golden) as f:
+        golden = json.load(f)
+    differences = compare(golden, current, options.tolerance)
+    if differences:
+        print(report(differences))
+    regressions = [d for d in differences if d[4]]
+    print(str(len(current)) + ' reference runs, ' + str(len(regressions)) + ' regressions' +
+          (' (re-record with "python -m tools.regression record" if they are intended)' if regressions else ''))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+'''
+Re-test runs of Station A against the pool maps of a pooling run, read off-robot with the
+recorder. The robot folder /var/lib/jupyter/notebooks is redirected to a temporary folder.
+
+    python -m unittest tools.test_retest
+'''
+import builtins
+import contextlib
+import csv
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from tools import recorder
+
+ROBOT_FOLDER = '/var/lib/jupyter/notebooks'
+STATIONS_A = [p for p in recorder.protocols() if p.endswith('Station_A.py')]
+
+
+@contextlib.contextmanager
+def robot_folder(folder):
+    '''
+    Files of the robot folder are read from folder instead
+    '''
+    real_open, real_isfile = builtins.open, os.path.isfile
+
+    def local(path):
+        return path.replace(ROBOT_FOLDER, folder, 1) if isinstance(path, str) else path
+
+    with mock.patch('builtins.open', lambda path, *args, **kwargs: real_open(local(path), *args, **kwargs)), \
+         mock.patch('os.path.isfile', lambda path: real_isfile(local(path))):
+        yield
+
+
+def write_pool_map(path, slot, num_tubes = 16, size = 4):
+    '''
+    Pool map of a plate of a pooling run as Station A writes it, with the tubes in rack slot
+    '''
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pool', 'well', 'tube', 'rack_load', 'slot', 'position', 'tip'])
+        for i in range(num_tubes):
+            writer.writerow([i // size + 1, 'ABCDEFGH'[i // size] + '1', i + 1, 1, slot,
+                             'ABCD'[i % 4] + str(i // 4 + 1), ''])
+
+
+def retested_tubes(path, folder, **variables):
+    '''
+    (slot, position) of the source tubes a re-test run aspirates from
+    '''
+    with robot_folder(folder):
+        ctx = recorder.simulate(path, **variables)
+    op, well = ctx.log.column('op'), ctx.log.column('well')
+    names = [ctx.log.wells[w] for w in set(well[op == recorder.OP_CODE['aspirate']].tolist())
+             if ctx.log.well_labware[w] == 'opentrons_24_tuberack_generic_2ml_screwcap']
+    return sorted((name.split(' on ')[-1], name.split(' ')[0]) for name in names)
+
+
+class RetestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.run_folder = os.path.join(self.folder.name, 'pooling')
+        os.mkdir(self.run_folder)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def retest(self, path, **variables):
+        return retested_tubes(path, self.folder.name, NUM_SAMPLES = 8, retest_run_id = 'pooling',
+                              positive_pools = [2], **variables)
+
+    def test_queued_plates_map_of_retest_plate(self):
+        # A pooling run with queued_plates = 2 writes a pool map per plate, its pool ids restart at 1
+        write_pool_map(os.path.join(self.run_folder, 'StationA_pool_map_plate1.csv'), '4')
+        write_pool_map(os.path.join(self.run_folder, 'StationA_pool_map_plate2.csv'), '1')
+        for path in STATIONS_A:
+            with self.subTest(path = path):
+                self.assertEqual(self.retest(path, retest_plate = 2),
+                                 [('1', 'A2'), ('1', 'B2'), ('1', 'C2'), ('1', 'D2')])
+                self.assertEqual(self.retest(path),
+                                 [('4', 'A2'), ('4', 'B2'), ('4', 'C2'), ('4', 'D2')])
+
+    def test_single_plate_map(self):
+        write_pool_map(os.path.join(self.run_folder, 'StationA_pool_map.csv'), '4')
+        for path in STATIONS_A:
+            with self.subTest(path = path):
+                self.assertEqual(self.retest(path),
+                                 [('4', 'A2'), ('4', 'B2'), ('4', 'C2'), ('4', 'D2')])
+
+    def test_pool_not_in_plate_map(self):
+        write_pool_map(os.path.join(self.run_folder, 'StationA_pool_map_plate1.csv'), '4')
+        write_pool_map(os.path.join(self.run_folder, 'StationA_pool_map_plate2.csv'), '1', num_tubes = 4)
+        for path in STATIONS_A:
+            with self.subTest(path = path):
+                with self.assertRaisesRegex(Exception, 'not in the pool map .*_plate2.csv'):
+                    self.retest(path, retest_plate = 2)
+
+
+if __name__ == '__main__':
+    unittest.main()